@@ -0,0 +1,69 @@
+"""
+Compares the ways of turning orders documents into objects.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_models
+
+Every case converts 10 000 documents shaped like the ones in the orders collection,
+``_id`` included, and prints the best of five runs. ``Order.deserialize`` validates every
+document, ``Order.model_construct`` skips validation but builds the model in Python, and
+``OrderRow.from_db`` fills a ``__slots__`` object from the projected document.
+"""
+import datetime
+import timeit
+
+from bson import ObjectId
+
+from src.model import Order, OrderRow
+
+DOCUMENTS = 10_000
+REPEAT = 5
+
+
+def order_documents() -> list[dict]:
+    """
+    Builds order documents as they are read from the orders collection.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return [{'_id': ObjectId(),
+             'invoice_id': i,
+             'value': 1_000_000_000,
+             'value_id': 1_000_000_000 + i,
+             'status': 'new',
+             'expires_at': now}
+            for i in range(DOCUMENTS)]
+
+
+def projected(documents: list[dict]) -> list[dict]:
+    """
+    Applies the OrderRow projection the way MongoDB would.
+    """
+    fields = [name for name, include in OrderRow.projection().items() if include]
+    return [{name: document[name] for name in fields} for document in documents]
+
+
+def best(statement) -> float:
+    """
+    Returns the best time of a statement over the runs, in milliseconds.
+    """
+    return min(timeit.repeat(statement, number=1, repeat=REPEAT)) * 1000
+
+
+def main() -> None:
+    documents = order_documents()
+    trimmed = projected(documents)
+    cases = {
+        'Order.deserialize': lambda: [Order.deserialize(document) for document in documents],
+        'Order.model_construct': lambda: [Order.model_construct(**document) for document in trimmed],
+        'OrderRow.from_db': lambda: [OrderRow.from_db(document) for document in trimmed],
+    }
+    baseline = None
+    for name, statement in cases.items():
+        elapsed = best(statement)
+        baseline = baseline or elapsed
+        print(f'{name:<24} {elapsed:8.1f} ms per {DOCUMENTS} documents  {baseline / elapsed:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
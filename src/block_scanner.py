@@ -0,0 +1,151 @@
+import logging
+
+from pytoniq import BalancerError
+from pytoniq_core import Address
+from pytoniq_core.tl import BlockIdExt
+
+from src import config_reader
+from src.db_manager import db_manager, DbManager
+from src.exceptions import ScanBlocksError, MongoError, TonClientError, TransactionManagerError, DuplicateError
+from src.leader import fenced
+from src.metrics import metrics
+from src.model import TransactionRecord
+from tr_manager import tr_manager, TransactionManager
+
+
+class BlockScanner:
+    """
+    A class used to ingest transactions of watched addresses by walking new blocks.
+
+    ...
+
+    Instead of one ``get_transactions`` call per address, every new masterchain block is
+    resolved to its workchain shard blocks once, the short transaction list of each shard
+    block (account, lt, hash) is filtered against an in-memory set of watched accounts, and
+    only matching transactions are downloaded and decoded into ``TransactionRecord``. The
+    cost per block is independent of the number of watched addresses.
+
+    The cursor (last scanned masterchain seqno and the last scanned seqno of every shard)
+    is persisted after each masterchain block, so a restart resumes where it stopped. The
+    write carries the fencing token of the manager, a deposed leader cannot move it back.
+    Shard blocks created between two masterchain blocks are walked by seqno; after a shard
+    split or merge the new shards are walked back to the last scanned blocks of their parents.
+
+    Attributes
+    ----------
+    manager : TransactionManager
+        the manager that confirms orders and stores transactions
+    db_manager : DbManager
+        a manager to interact with the database
+    max_blocks_per_scan : int
+        the number of masterchain blocks processed by one scan
+    watched : dict
+        the watched addresses by (workchain, account id)
+
+    Methods
+    -------
+    scan():
+        Processes the masterchain blocks created since the last scan.
+    """
+    col_name = 'cursors'
+    cursor_id = 'block_scanner'
+
+    def __init__(self, manager: TransactionManager, db_man: DbManager, max_blocks_per_scan: int = 50):
+        """
+        Constructs all the necessary attributes for the BlockScanner object.
+
+        Parameters
+        ----------
+        manager : TransactionManager
+            the manager that confirms orders and stores transactions
+        db_man : DbManager
+            a manager to interact with the database
+        max_blocks_per_scan : int, optional
+            the number of masterchain blocks processed by one scan
+        """
+        self.manager = manager
+        self.client = manager.client
+        self.db_manager = db_man
+        self.max_blocks_per_scan = max_blocks_per_scan
+        self.watched: dict[tuple[int, bytes], str] = {}
+
+    async def scan(self) -> int:
+        """
+        Processes the masterchain blocks created since the last scan.
+
+        Returns
+        -------
+        int
+            The number of transactions of watched addresses found.
+
+        Raises
+        ------
+        ScanBlocksError
+            If an error occurs while scanning blocks.
+        """
+        try:
+            if not self.watched:
+                for address in self.manager.addresses:
+                    parsed = Address(address)
+                    self.watched[(parsed.wc, parsed.hash_part)] = address
+            await self.client.start()
+            last_seqno = (await self.client.get_masterchain_info())['last']['seqno']
+            cursor = await self.db_manager.get_one(col_name=self.col_name, fltr={'_id': self.cursor_id})
+            if not cursor:
+                cursor = {'seqno': last_seqno - 1, 'shards': {}}
+
+            found = 0
+            for seqno in range(cursor['seqno'] + 1, min(last_seqno, cursor['seqno'] + self.max_blocks_per_scan) + 1):
+                found += await self._scan_masterchain_block(seqno, cursor['shards'])
+                cursor['seqno'] = seqno
+                fltr, update = fenced({'_id': self.cursor_id},
+                                      {'$set': {'seqno': seqno, 'shards': cursor['shards']}},
+                                      self.manager.fence)
+                await self.db_manager.update_one(col_name=self.col_name, fltr=fltr, update=update)
+            return found
+        except DuplicateError as e:
+            raise ScanBlocksError('The block scan cursor was written by a newer leader') from e
+        except (BalancerError,
+                MongoError,
+                TonClientError,
+                TransactionManagerError,
+                Exception) as e:
+            logging.exception('Error in scanning blocks')
+            raise ScanBlocksError from e
+
+    async def _scan_masterchain_block(self, seqno: int, shards: dict[str, int]) -> int:
+        """
+        Ingests the watched transactions of every shard block referenced by a masterchain block.
+        """
+        found = 0
+        for block in await self.client.get_shard_blocks(seqno, shards):
+            found += await self._scan_shard_block(block)
+        return found
+
+    async def _scan_shard_block(self, block: BlockIdExt) -> int:
+        """
+        Downloads and ingests the transactions of watched addresses in one shard block.
+        """
+        by_address: dict[str, list[TransactionRecord]] = {}
+        for transaction_id in await self.client.raw_get_block_transactions(block):
+            account: Address = transaction_id['account']
+            address = self.watched.get((account.wc, account.hash_part))
+            if address is None:
+                continue
+            transaction = await self.client.get_one_transaction(account, transaction_id['lt'], block)
+            if transaction is None or transaction.in_msg is None or not transaction.in_msg.is_internal:
+                continue
+            try:
+                record = TransactionRecord.from_transaction(transaction, address)
+            except Exception:
+                logging.exception(f'Error in decoding transaction {transaction_id["lt"]} of {address}, skipped')
+                metrics.inc('transactions_undecodable')
+                continue
+            by_address.setdefault(address, []).append(record)
+
+        for address, transactions in by_address.items():
+            await self.manager.ingest(transactions, address)
+        return sum(len(transactions) for transactions in by_address.values())
+
+
+block_scanner = BlockScanner(tr_manager, db_manager, config_reader.config.max_blocks_per_scan)
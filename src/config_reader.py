@@ -1,4 +1,6 @@
-from pydantic import SecretStr
+import socket
+
+from pydantic import Field, SecretStr
 from pydantic_settings import BaseSettings
 
 
@@ -12,21 +14,110 @@ class Setting(BaseSettings):
     ----------
     pay_address : SecretStr
         The payment address.
+    pay_addresses : list[str]
+        Additional watched payment addresses.
+    max_concurrent_addresses : int
+        The number of addresses polled at the same time.
     db_cluster_name : SecretStr
         The name of the database cluster.
     database : SecretStr
         The database.
     app_port : SecretStr
         The application port.
+    order_ttl : int
+        Seconds after which a NEW order is canceled, 0 disables expiry.
+    sweep_interval : int
+        Seconds between two runs of the expired order sweeper.
+    sweep_batch_size : int
+        The number of expired orders canceled in one batch.
+    value_id_grace : float
+        Seconds the value id of a canceled order is held back before it is reused.
+    poll_min_interval : float
+        Seconds between two poll cycles while orders are pending.
+    poll_max_interval : float
+        The longest pause between two poll cycles when idle.
+    watch_mode : str
+        'poll' to poll transactions on a schedule, 'subscribe' to follow new blocks
+        and only poll the watched addresses that changed, 'block_scan' to read the
+        watched transactions straight from every new block.
+    max_blocks_per_scan : int
+        The number of masterchain blocks processed by one block scan.
+    order_cache_size : int
+        The number of invoice ids kept in the order cache.
+    order_cache_ttl : float
+        Seconds a found order stays in the order cache.
+    order_cache_negative_ttl : float
+        Seconds an unknown invoice id stays in the order cache.
+    long_poll_timeout : float
+        The longest time a request waits for the status of an order to change.
+    order_change_stream : bool
+        Whether to follow order changes made by other replicas through a change stream.
+    replica_id : str
+        The id of this replica, the host name by default.
+    leader_election : bool
+        Whether replicas elect a single one of them to run the poller.
+    lease_ttl : float
+        Seconds the poller lease stays valid without a heartbeat.
+    lease_heartbeat : float
+        Seconds between two renewals of the poller lease.
+    serve_mode : str
+        'all' to run the API together with the poller, 'api' to serve only the API under
+        hypercorn and run the poller separately with ``src/poller.py``. The 'api' mode
+        needs ``order_change_stream``.
+    api_workers : int
+        The number of hypercorn worker processes in 'api' serve mode.
+    poller_metrics_interval : float
+        Seconds between two publications of the metrics of a separate poller process.
+    coalesce_inserts : list[str]
+        Collections whose single inserts are grouped into batches, e.g. ["orders"].
+    coalesce_window_ms : float
+        Milliseconds a batch of inserts waits for more documents.
+    coalesce_max_batch : int
+        The number of documents that flushes a batch of inserts at once.
+    max_batch_size : int
+        The most orders or invoice ids accepted by one batch request.
 
     Methods
     -------
-    None
+    watched_addresses():
+        Returns every address payments are accepted on.
     """
     pay_address: SecretStr
+    pay_addresses: list[str] = []
+    max_concurrent_addresses: int = 16
     db_cluster_name: SecretStr
     database: SecretStr
     app_port: SecretStr
+    order_ttl: int = 3600
+    sweep_interval: int = 60
+    sweep_batch_size: int = 500
+    value_id_grace: float = 86400
+    poll_min_interval: float = 3
+    poll_max_interval: float = 60
+    watch_mode: str = 'poll'
+    max_blocks_per_scan: int = 50
+    order_cache_size: int = 10000
+    order_cache_ttl: float = 5
+    order_cache_negative_ttl: float = 1
+    long_poll_timeout: float = 30
+    order_change_stream: bool = False
+    replica_id: str = Field(default_factory=socket.gethostname)
+    leader_election: bool = False
+    lease_ttl: float = 6
+    lease_heartbeat: float = 2
+    serve_mode: str = 'all'
+    api_workers: int = 1
+    poller_metrics_interval: float = 10
+    coalesce_inserts: list[str] = []
+    coalesce_window_ms: float = 5
+    coalesce_max_batch: int = 100
+    max_batch_size: int = 500
+
+    def watched_addresses(self) -> list[str]:
+        """
+        Returns every address payments are accepted on, without duplicates.
+        """
+        return list(dict.fromkeys([self.pay_address.get_secret_value(), *self.pay_addresses]))
 
     class Config:
         env_file = '.env'
@@ -1,14 +1,17 @@
 import asyncio
 import logging
-from typing import List
+from typing import AsyncIterator, List
 
 import motor
 import motor.motor_asyncio
-from pymongo.errors import PyMongoError
+from bson import ObjectId
+from pymongo import UpdateOne, ReturnDocument, IndexModel
+from pymongo.errors import PyMongoError, BulkWriteError, DuplicateKeyError, OperationFailure
 from pymongo.results import InsertOneResult
 
-import config_reader
-from exceptions import UpdateError, GetOneError, InsertError, GetManyError, DeleteError, MongoConnectionError
+from src import config_reader
+from src.exceptions import UpdateError, GetOneError, InsertError, GetManyError, DeleteError, MongoConnectionError, \
+    MongoError, DuplicateError, WatchError
 from abc import ABC, abstractmethod
 
 
@@ -33,20 +36,52 @@ class Database(ABC):
         pass
 
     @abstractmethod
-    async def get_one(self, col_name: str, fltr: dict, max_retries: int = 3, retry_delay: int = 1) -> dict | None:
+    async def insert_many_unordered(self, col_name: str, data: list[dict], max_retries: int = 3,
+                                    retry_delay: int = 1) -> list[str | MongoError]:
+        """
+        Inserts documents in one unordered batch and reports the result of every document.
+        """
+        pass
+
+    @abstractmethod
+    async def upsert_many(self, col_name: str, documents: list[tuple[dict, dict]], max_retries: int = 3,
+                          retry_delay: int = 1) -> tuple[int, int]:
+        """
+        Inserts (key, document) pairs whose key is not in the collection yet.
+        """
+        pass
+
+    @abstractmethod
+    async def get_one(self, col_name: str, fltr: dict, sort=None, projection: dict = None, max_retries: int = 3,
+                      retry_delay: int = 1) -> dict | None:
         """
         Retrieves a single document from a collection.
         """
         pass
 
     @abstractmethod
-    async def get_many(self, col_name: str, fltr: dict = None, max_retries: int = 3, retry_delay: int = 1) -> List[
-                                                                                                                  dict] | None:
+    async def get_many(self, col_name: str, fltr: dict = None, sort=None, limit: int = 0, projection: dict = None,
+                       max_retries: int = 3, retry_delay: int = 1) -> List[dict] | None:
         """
         Retrieves multiple documents from a collection.
         """
         pass
 
+    @abstractmethod
+    def iter_many(self, col_name: str, fltr: dict = None, sort=None, limit: int = 0, projection: dict = None,
+                  batch_size: int = 1000, max_retries: int = 3, retry_delay: int = 1) -> AsyncIterator[dict]:
+        """
+        Streams the documents of a collection matching a filter, batch_size at a time.
+        """
+        pass
+
+    @abstractmethod
+    def watch(self, col_name: str, pipeline: list[dict] = None, resume_after: dict = None) -> AsyncIterator[dict]:
+        """
+        Streams the change events of a collection, starting after a resume token if given.
+        """
+        pass
+
     @abstractmethod
     async def update_one(self, col_name: str, fltr: dict, update: dict, max_retries: int = 3,
                          retry_delay: int = 1) -> bool | None:
@@ -63,6 +98,23 @@ class Database(ABC):
         """
         pass
 
+    @abstractmethod
+    async def bulk_update(self, col_name: str, updates: list[tuple[dict, dict]], key: str = '_id',
+                          max_retries: int = 3, retry_delay: int = 1) -> List[bool]:
+        """
+        Applies (filter, update) pairs to a collection as one unordered batch and tells which were applied.
+        """
+        pass
+
+    @abstractmethod
+    async def find_one_and_update(self, col_name: str, fltr: dict, update: dict, upsert: bool = False,
+                                  return_new: bool = True, max_retries: int = 3,
+                                  retry_delay: int = 1) -> dict | None:
+        """
+        Atomically updates a single document and returns it after (or before) the update.
+        """
+        pass
+
     @abstractmethod
     async def replace_one(self, col_name: str, fltr: dict, replacement: dict, max_retries: int = 3,
                           retry_delay: int = 1) -> bool | None:
@@ -78,6 +130,13 @@ class Database(ABC):
         """
         pass
 
+    @abstractmethod
+    async def ensure_indexes(self, registry: dict[str, list[IndexModel]]) -> dict[str, list[str]]:
+        """
+        Creates the missing indexes of a registry and reports the ones that differ.
+        """
+        pass
+
 
 class Mongo(Database):
     """
@@ -93,7 +152,8 @@ class Mongo(Database):
        The MongoDB database.
     """
     def __init__(self, url: str, database: str):
-        self.client = motor.motor_asyncio.AsyncIOMotorClient(url)
+        # datetimes are read back as UTC-aware, like the ones the service writes
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(url, tz_aware=True)
         self.db = self.client[database]
 
     async def insert(self, col_name: str, data: dict, max_retries: int = 3,
@@ -106,6 +166,9 @@ class Mongo(Database):
             try:
                 result: InsertOneResult = await self.db[col_name].insert_one(data)
                 return str(result.inserted_id)
+            except DuplicateKeyError as err:
+                raise DuplicateError(f"Duplicate key during insert: {err}",
+                                     key_pattern=(err.details or {}).get('keyPattern')) from err
             except PyMongoError as err:
                 logging.error(f"Error during insert: {err}. Retrying...")
                 retries += 1
@@ -134,7 +197,89 @@ class Mongo(Database):
                     logging.error(error_message)
                     raise InsertError(error_message) from err
 
-    async def get_one(self, col_name: str, fltr: dict, sort=None, max_retries: int = 3,
+    async def insert_many_unordered(self, col_name: str, data: list[dict], max_retries: int = 3,
+                                    retry_delay: int = 1) -> list[str | MongoError]:
+        """
+        Inserts documents in one unordered batch and reports the result of every document.
+        Each result is the id of the inserted document, a DuplicateError, or an InsertError.
+        Documents that failed for another reason are retried. A retried document whose
+        ``_id`` already exists was stored by the failed attempt and counts as inserted.
+        """
+        for document in data:
+            document.setdefault('_id', ObjectId())
+        results: list[str | MongoError | None] = [None] * len(data)
+        pending = list(range(len(data)))
+        retries = 0
+        while pending and retries < max_retries:
+            try:
+                await self.db[col_name].insert_many([data[i] for i in pending], ordered=False)
+                for i in pending:
+                    results[i] = str(data[i]['_id'])
+                pending = []
+            except BulkWriteError as err:
+                failed = {pending[write_error['index']]: write_error
+                          for write_error in err.details.get('writeErrors', [])}
+                retry = []
+                for i in pending:
+                    write_error = failed.get(i)
+                    if write_error is None:
+                        results[i] = str(data[i]['_id'])
+                    elif write_error.get('code') != 11000:
+                        retry.append(i)
+                    elif retries and write_error.get('keyPattern') == {'_id': 1}:
+                        results[i] = str(data[i]['_id'])
+                    else:
+                        results[i] = DuplicateError(f"Duplicate key during insert: {write_error.get('errmsg')}",
+                                                    key_pattern=write_error.get('keyPattern'))
+                pending = retry
+                if pending:
+                    logging.error(f"Error during insert_many of {len(pending)} documents: {err}. Retrying...")
+                    retries += 1
+                    await asyncio.sleep(retry_delay)
+            except PyMongoError as err:
+                logging.error(f"Error during insert_many: {err}. Retrying...")
+                retries += 1
+                await asyncio.sleep(retry_delay)
+        for i in pending:
+            results[i] = InsertError(f"Failed to insert document after {max_retries} retries")
+        return results
+
+    async def upsert_many(self, col_name: str, documents: list[tuple[dict, dict]], max_retries: int = 3,
+                          retry_delay: int = 1) -> tuple[int, int]:
+        """
+        Inserts (key, document) pairs whose key is not in the collection yet.
+        Returns the number of inserted documents and the number of duplicates.
+        """
+        inserted = 0
+        pending = list(range(len(documents)))
+        retries = 0
+        while pending and retries < max_retries:
+            operations = [UpdateOne(documents[i][0], {'$setOnInsert': documents[i][1]}, upsert=True)
+                          for i in pending]
+            try:
+                result = await self.db[col_name].bulk_write(operations, ordered=False)
+                inserted += result.upserted_count
+                pending = []
+            except BulkWriteError as err:
+                inserted += err.details.get('nUpserted', 0)
+                # a concurrent upsert of the same key is a duplicate, not a failure
+                pending = [pending[write_error['index']] for write_error in err.details.get('writeErrors', [])
+                           if write_error.get('code') != 11000]
+                if pending:
+                    logging.error(f"Error during upsert_many of {len(pending)} documents: {err}. Retrying...")
+                    retries += 1
+                    await asyncio.sleep(retry_delay)
+            except PyMongoError as err:
+                logging.error(f"Error during upsert_many: {err}. Retrying...")
+                retries += 1
+                await asyncio.sleep(retry_delay)
+        if pending:
+            error_message = f"Failed to upsert {len(pending)} documents after {max_retries} retries"
+            logging.error(error_message)
+            raise InsertError(error_message)
+        return inserted, len(documents) - inserted
+
+    async def get_one(self, col_name: str, fltr: dict, sort=None, projection: dict = None, max_retries: int = 3,
                       retry_delay: int = 1) -> dict | None:
         """
         Retrieves a single document from a collection.
@@ -143,6 +288,7 @@ class Mongo(Database):
         while retries < max_retries:
             try:
                 result = await self.db[col_name].find_one(filter=fltr,
+                                                          projection=projection,
                                                           sort=sort)
                 return result
             except PyMongoError as err:
@@ -154,18 +300,16 @@ class Mongo(Database):
                     logging.error(error_message)
                     raise GetOneError(error_message) from err
 
-    async def get_many(self, col_name: str, fltr: dict = None, max_retries: int = 3, retry_delay: int = 1) -> list:
+    async def get_many(self, col_name: str, fltr: dict = None, sort=None, limit: int = 0, projection: dict = None,
+                       max_retries: int = 3, retry_delay: int = 1) -> list:
         """
         Retrieves multiple documents from a collection.
         """
         retries = 0
         while retries < max_retries:
             try:
-                if fltr is None:
-                    result = await self.db[col_name].find().to_list(None)
-                else:
-                    result = await self.db[col_name].find(fltr).to_list(None)
-                return result  # WARNING: Maybe this is not the best way to return the data
+                result = await self.db[col_name].find(fltr, projection=projection, sort=sort, limit=limit).to_list(None)
+                return result  # loads the whole result set, use iter_many for large ones
             except PyMongoError as err:
                 logging.error(f"Error during find: {err}. Retrying...")
                 retries += 1
@@ -175,6 +319,62 @@ class Mongo(Database):
                     logging.error(error_message)
                     raise GetManyError(error_message) from err
 
+    async def iter_many(self, col_name: str, fltr: dict = None, sort=None, limit: int = 0, projection: dict = None,
+                        batch_size: int = 1000, max_retries: int = 3, retry_delay: int = 1) -> AsyncIterator[dict]:
+        """
+        Streams the documents of a collection matching a filter, batch_size at a time.
+
+        Only one batch is held in memory. A failure before the first document is retried,
+        a failure in the middle of the stream is raised since the documents already
+        yielded cannot be taken back.
+        """
+        retries = 0
+        yielded = 0
+        while retries < max_retries:
+            cursor = self.db[col_name].find(fltr, projection=projection, sort=sort, limit=limit,
+                                            batch_size=batch_size)
+            try:
+                async for document in cursor:
+                    yielded += 1
+                    yield document
+                return
+            except PyMongoError as err:
+                if yielded:
+                    error_message = f"Cursor failed after {yielded} documents: {err}"
+                    logging.error(error_message)
+                    raise GetManyError(error_message) from err
+                logging.error(f"Error during find: {err}. Retrying...")
+                retries += 1
+                await asyncio.sleep(retry_delay)
+                if retries == max_retries:
+                    error_message = f"Failed to find documents after {max_retries} retries"
+                    logging.error(error_message)
+                    raise GetManyError(error_message) from err
+            finally:
+                await cursor.close()
+
+    async def watch(self, col_name: str, pipeline: list[dict] = None,
+                    resume_after: dict = None) -> AsyncIterator[dict]:
+        """
+        Streams the change events of a collection, starting after a resume token if given.
+
+        Events carry the full document after the change. Transient errors are resumed by
+        the driver itself, anything else is raised as a WatchError carrying the server
+        error code, e.g. 286 when the resume token fell off the oplog.
+        """
+        try:
+            async with self.db[col_name].watch(pipeline or [],
+                                               full_document='updateLookup',
+                                               resume_after=resume_after) as stream:
+                async for change in stream:
+                    yield change
+        except OperationFailure as err:
+            logging.error(f"Error during watch: {err}")
+            raise WatchError(str(err), code=err.code) from err
+        except PyMongoError as err:
+            logging.error(f"Error during watch: {err}")
+            raise WatchError(str(err)) from err
+
     async def update_one(self, col_name: str, fltr: dict, update: dict,
                          max_retries: int = 3, retry_delay: int = 1) -> bool | None:
         """
@@ -187,6 +387,10 @@ class Mongo(Database):
                                                             update=update,
                                                             upsert=True)
                 return result.modified_count > 0
+            except DuplicateKeyError as err:
+                # the filter missed an existing document, so the upsert collided with it
+                raise DuplicateError(f"Duplicate key during update: {err}",
+                                     key_pattern=(err.details or {}).get('keyPattern')) from err
             except PyMongoError as err:
                 error_message = f"Error during update: {err}. Retrying..."
                 logging.error(error_message)
@@ -196,6 +400,29 @@ class Mongo(Database):
                     logging.error(f"Failed to update document after {max_retries} retries")
                     raise UpdateError(error_message) from err
 
+    async def find_one_and_update(self, col_name: str, fltr: dict, update: dict, upsert: bool = False,
+                                  return_new: bool = True, max_retries: int = 3,
+                                  retry_delay: int = 1) -> dict | None:
+        """
+        Atomically updates a single document and returns it after (or before) the update.
+        """
+        retries = 0
+        while retries < max_retries:
+            try:
+                return await self.db[col_name].find_one_and_update(filter=fltr,
+                                                                   update=update,
+                                                                   upsert=upsert,
+                                                                   return_document=ReturnDocument.AFTER
+                                                                   if return_new else ReturnDocument.BEFORE)
+            except PyMongoError as err:
+                error_message = f"Error during find_one_and_update: {err}. Retrying..."
+                logging.error(error_message)
+                retries += 1
+                await asyncio.sleep(retry_delay)
+                if retries == max_retries:
+                    logging.error(f"Failed to update document after {max_retries} retries")
+                    raise UpdateError(error_message) from err
+
     async def replace_one(self, col_name: str, fltr: dict, replacement: dict,
                           max_retries: int = 3, retry_delay: int = 1) -> bool | None:
         """
@@ -236,6 +463,62 @@ class Mongo(Database):
                     logging.error(error_message)
                     raise UpdateError(error_message) from err
 
+    async def bulk_update(self, col_name: str, updates: list[tuple[dict, dict]], key: str = '_id',
+                          max_retries: int = 3, retry_delay: int = 1) -> List[bool]:
+        """
+        Applies (filter, update) pairs to a collection as one unordered batch and tells which were applied.
+        A bulk write only reports how many filters matched in total. When fewer matched than
+        updates were sent, the documents are read back by the ``key`` field of the filters and
+        an update counts as applied if its document carries every value of its ``$set``, so
+        the ``$set`` should hold a value unique to the write. Only the updates that failed
+        with a write error are retried. Updates still failing after ``max_retries`` count as
+        not applied unless the read-back finds them applied, the rest of the batch is kept.
+        UpdateError is only raised when the applied updates cannot be told at all.
+        """
+        matched = 0
+        pending = list(range(len(updates)))
+        retries = 0
+        while pending and retries < max_retries:
+            try:
+                result = await self.db[col_name].bulk_write([UpdateOne(*updates[i]) for i in pending], ordered=False)
+                matched += result.matched_count
+                pending = []
+            except BulkWriteError as err:
+                matched += err.details.get('nMatched', 0)
+                pending = [pending[write_error['index']] for write_error in err.details.get('writeErrors', [])]
+                logging.error(f"Error during bulk_update of {len(pending)} documents: {err}. Retrying...")
+                retries += 1
+                await asyncio.sleep(retry_delay)
+            except PyMongoError as err:
+                logging.error(f"Error during bulk_update: {err}. Retrying...")
+                retries += 1
+                await asyncio.sleep(retry_delay)
+        if pending:
+            logging.error(f"Failed to update {len(pending)} documents after {max_retries} retries")
+        written = len(updates) - len(pending)
+        if not pending and matched >= written:
+            return [True] * len(updates)
+
+        fields = {field for _, update in updates for field in update.get('$set', {})}
+        try:
+            documents = {document[key]: document
+                         for document in await self.get_many(col_name,
+                                                             fltr={key: {'$in': [fltr[key] for fltr, _ in updates]}},
+                                                             projection={key: 1, **{field: 1 for field in fields}},
+                                                             max_retries=max_retries,
+                                                             retry_delay=retry_delay)}
+        except GetManyError as err:
+            if not written or matched < written:
+                error_message = f"Failed to tell which of {len(updates)} updates were applied"
+                logging.error(error_message)
+                raise UpdateError(error_message) from err
+            # every written update matched, so only the failed ones were not applied
+            failed = set(pending)
+            return [i not in failed for i in range(len(updates))]
+        return [fltr[key] in documents
+                and all(documents[fltr[key]].get(field) == value for field, value in update.get('$set', {}).items())
+                for fltr, update in updates]
+
     async def delete_one(self, col_name: str, fltr: dict, max_retries: int = 3, retry_delay: int = 1) -> bool | None:
         """
         Deletes a single document from a collection.
@@ -254,6 +537,42 @@ class Mongo(Database):
                     logging.error(f"Failed to delete document after {max_retries} retries")
                     raise DeleteError(error_message) from err
 
+    async def ensure_indexes(self, registry: dict[str, list[IndexModel]]) -> dict[str, list[str]]:
+        """
+        Creates the missing indexes of a registry and reports the ones that differ.
+        Existing indexes are never dropped, mismatches have to be resolved by hand.
+        """
+        report = {'created': [], 'mismatched': [], 'failed': [], 'unknown': []}
+        for col_name, models in registry.items():
+            try:
+                existing = await self.db[col_name].index_information()
+            except PyMongoError as err:
+                logging.error(f"Error during index_information of {col_name}: {err}")
+                report['failed'].extend(f"{col_name}.{model.document['name']}" for model in models)
+                continue
+            expected_names = {'_id_'}
+            for model in models:
+                spec = model.document
+                name = f"{col_name}.{spec['name']}"
+                expected_names.add(spec['name'])
+                if spec['name'] in existing:
+                    if _index_options(existing[spec['name']]) != _index_options(spec):
+                        report['mismatched'].append(name)
+                    continue
+                try:
+                    await self.db[col_name].create_indexes([model])
+                    report['created'].append(name)
+                except PyMongoError as err:
+                    logging.error(f"Error during create_indexes of {name}: {err}")
+                    report['failed'].append(name)
+            report['unknown'].extend(f"{col_name}.{index_name}" for index_name in existing
+                                     if index_name not in expected_names)
+        for status, names in report.items():
+            if names:
+                log = logging.info if status == 'created' else logging.warning
+                log(f"Indexes {status}: {', '.join(names)}")
+        return report
+
 
 try:
     db = Mongo(url=config_reader.config.database.get_secret_value(),
@@ -261,3 +580,12 @@ try:
 except PyMongoError as e:
     logging.error(f"Error in connecting to the database: {e}")
     raise MongoConnectionError("Error in connecting to the database") from e
+
+
+def _index_options(spec: dict) -> dict:
+    """
+    Extracts the options that make two indexes with the same name different.
+    """
+    return {'key': [tuple(item) for item in dict(spec['key']).items()],
+            'unique': bool(spec.get('unique', False)),
+            'partialFilterExpression': spec.get('partialFilterExpression')}
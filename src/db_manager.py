@@ -1,24 +1,51 @@
-from db import Database, db
+from typing import AsyncIterator
+
+from pymongo import IndexModel
+
+from src import config_reader
+from src.db import Database, db
+from src.insert_coalescer import InsertCoalescer
 
 
 class DbManager:
-    def __init__(self, db: Database):
+    def __init__(self, db: Database, coalesce: list[str] = (), coalesce_window: float = 0.005,
+                 coalesce_max_batch: int = 100):
         self.db = db
+        # collections whose single inserts are grouped into unordered insert_many batches
+        self.coalescers = {col_name: InsertCoalescer(db, col_name, coalesce_window, coalesce_max_batch)
+                           for col_name in coalesce}
 
     async def add_one(self, col_name: str, data: dict):
+        coalescer = self.coalescers.get(col_name)
+        if coalescer is not None:
+            return await coalescer.submit(data)
         return await self.db.insert(col_name, data)
 
     async def add_many(self, col_name: str, data: list[dict]):
         return await self.db.insert_many(col_name, data)
 
-    async def get_one(self, col_name: str, fltr: dict, sort=None) -> dict:
-        return await self.db.get_one(col_name, fltr, sort)
+    async def add_many_unordered(self, col_name: str, data: list[dict]) -> list:
+        return await self.db.insert_many_unordered(col_name, data)
+
+    async def upsert_many(self, col_name: str, documents: list[tuple[dict, dict]]) -> tuple[int, int]:
+        return await self.db.upsert_many(col_name, documents)
+
+    async def get_one(self, col_name: str, fltr: dict, sort=None, projection: dict = None) -> dict:
+        return await self.db.get_one(col_name, fltr, sort, projection)
 
     async def get_many_async(self, col_name: str, fltr: dict = None) -> list[dict]:
         return await self.db.get_many(col_name, fltr)
 
-    async def get_many(self, col_name: str, fltr: dict = None) -> list[dict]:
-        return await self.db.get_many(col_name, fltr)
+    async def get_many(self, col_name: str, fltr: dict = None, sort=None, limit: int = 0,
+                       projection: dict = None) -> list[dict]:
+        return await self.db.get_many(col_name, fltr, sort, limit, projection)
+
+    def iter_many(self, col_name: str, fltr: dict = None, sort=None, limit: int = 0, projection: dict = None,
+                  batch_size: int = 1000) -> AsyncIterator[dict]:
+        return self.db.iter_many(col_name, fltr, sort, limit, projection, batch_size)
+
+    def watch(self, col_name: str, pipeline: list[dict] = None, resume_after: dict = None) -> AsyncIterator[dict]:
+        return self.db.watch(col_name, pipeline, resume_after)
 
     async def update_one(self, col_name: str, fltr: dict, update: dict):
         return await self.db.update_one(col_name, fltr, update)
@@ -26,11 +53,24 @@ class DbManager:
     async def update_many(self, col_name: str, fltr: dict, update: dict):
         return await self.db.update_many(col_name, fltr, update)
 
+    async def bulk_update(self, col_name: str, updates: list[tuple[dict, dict]], key: str = '_id') -> list[bool]:
+        return await self.db.bulk_update(col_name, updates, key)
+
+    async def find_one_and_update(self, col_name: str, fltr: dict, update: dict, upsert: bool = False,
+                                  return_new: bool = True):
+        return await self.db.find_one_and_update(col_name, fltr, update, upsert, return_new)
+
     async def replace_one(self, col_name: str, fltr: dict, replacement: dict):
         return await self.db.replace_one(col_name, fltr, replacement)
 
     async def delete_one(self, col_name: str, fltr: dict):
         return await self.db.delete_one(col_name, fltr)
 
+    async def ensure_indexes(self, registry: dict[str, list[IndexModel]]) -> dict[str, list[str]]:
+        return await self.db.ensure_indexes(registry)
+
 
-db_manager: DbManager = DbManager(db)
+db_manager: DbManager = DbManager(db,
+                                  coalesce=config_reader.config.coalesce_inserts,
+                                  coalesce_window=config_reader.config.coalesce_window_ms / 1000,
+                                  coalesce_max_batch=config_reader.config.coalesce_max_batch)
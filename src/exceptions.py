@@ -29,6 +29,15 @@ class GetTransactionsError(TonClientError):
         super().__init__(self.message)
 
 
+class WatchAccountError(TonClientError):
+    """
+    Exception raised for errors occurring while following new blocks.
+    """
+    def __init__(self, message="An error occurred while following new blocks"):
+        self.message = message
+        super().__init__(self.message)
+
+
 class MongoError(Exception):
     """
     Base class for exceptions in this module.
@@ -63,6 +72,20 @@ class InsertError(MongoError):
         super().__init__(self.message)
 
 
+class DuplicateError(InsertError):
+    """
+    Exception raised when an inserted document violates a unique index.
+
+    Attributes:
+        message -- explanation of the error
+        key_pattern -- the keys of the violated index
+    """
+
+    def __init__(self, message="The document violates a unique index", key_pattern: dict = None):
+        self.key_pattern = key_pattern or {}
+        super().__init__(message)
+
+
 class GetOneError(MongoError):
     """
     Exception raised for errors occurring during data retrieval from MongoDB.
@@ -115,6 +138,21 @@ class UpdateError(MongoError):
         super().__init__(self.message)
 
 
+class WatchError(MongoError):
+    """
+    Exception raised for errors occurring while following a change stream in MongoDB.
+
+    Attributes:
+        message -- explanation of the error
+        code -- the MongoDB error code, None for network errors
+    """
+
+    def __init__(self, message="An error occurred while watching a collection in MongoDB", code=None):
+        self.message = message
+        self.code = code
+        super().__init__(self.message)
+
+
 class TransactionManagerError(Exception):
     """
     Base class for exceptions in this module.
@@ -166,3 +204,38 @@ class GetOldLatestTransactionError(TransactionManagerError):
     def __init__(self, message="An error occurred while getting the old latest transaction"):
         self.message = message
         super().__init__(self.message)
+
+
+class ScanBlocksError(TransactionManagerError):
+    """
+    Exception raised for errors occurring during scanning new blocks.
+    """
+    def __init__(self, message="An error occurred while scanning new blocks"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class OrderError(Exception):
+    """
+    Base class for exceptions in this module.
+    All exceptions generated while handling orders should inherit from this class.
+    """
+    pass
+
+
+class AllocateValueIdError(OrderError):
+    """
+    Exception raised for errors occurring during value id allocation.
+    """
+    def __init__(self, message="An error occurred while allocating a value id"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class SweepOrdersError(OrderError):
+    """
+    Exception raised for errors occurring during canceling expired orders.
+    """
+    def __init__(self, message="An error occurred while canceling expired orders"):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,33 @@
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from src.model import OrderStatus
+
+# Indexes backing every query shape the service runs, created idempotently at startup.
+# Names are left to MongoDB so they match indexes created by earlier versions.
+INDEXES: dict[str, list[IndexModel]] = {
+    'orders': [
+        # GET /transactions and comment matching, one order per invoice
+        IndexModel([('invoice_id', ASCENDING)], unique=True),
+        # the allocator's resync, the highest value_id of the NEW orders with a given value
+        IndexModel([('status', ASCENDING), ('value', ASCENDING), ('value_id', ASCENDING)]),
+        # no two NEW orders may share a value_id, also serves the poller's
+        # {'status': 'new', 'value_id': {'$in': ...}} lookup
+        IndexModel([('value_id', ASCENDING)], unique=True,
+                   partialFilterExpression={'status': OrderStatus.NEW.value}),
+        # expired order sweeper
+        IndexModel([('status', ASCENDING), ('expires_at', ASCENDING)]),
+        # the poller's check for transactions that already paid an order
+        IndexModel([('paid_by', ASCENDING)], partialFilterExpression={'paid_by': {'$type': 'string'}}),
+    ],
+    'transactions': [
+        # one document per transaction; documents stored before ingestion was deduplicated
+        # have no address and no hash and may repeat an lt, so they are left out
+        IndexModel([('address', ASCENDING), ('lt', DESCENDING), ('hash', ASCENDING)], unique=True,
+                   partialFilterExpression={'hash': {'$type': 'string'}}),
+        # the latest-lt lookup of an address, which also reads the older documents
+        IndexModel([('address', ASCENDING), ('lt', DESCENDING)]),
+    ],
+    'checkpoints': [
+        IndexModel([('address', ASCENDING)], unique=True),
+    ],
+}
@@ -0,0 +1,118 @@
+import asyncio
+
+from src.db import Database
+from src.metrics import metrics
+
+
+class InsertCoalescer:
+    """
+    A class used to group concurrent single-document inserts into one collection.
+
+    ...
+
+    Documents submitted within ``window`` seconds of the first one, or until
+    ``max_batch`` documents are waiting, are written with one unordered ``insert_many``.
+    Every caller waits for the batch its document is part of and gets its own result:
+    the inserted id, or the error of its own document. A caller only returns once its
+    write is acknowledged, exactly like a single insert.
+
+    Attributes
+    ----------
+    db : Database
+        the database the batches are written to
+    col_name : str
+        the collection the documents are inserted into
+    window : float
+        seconds a batch waits for more documents
+    max_batch : int
+        the number of documents that flushes a batch at once
+
+    Methods
+    -------
+    submit(document):
+        Inserts a document as part of the next batch.
+    """
+    def __init__(self, db: Database, col_name: str, window: float, max_batch: int):
+        """
+        Constructs all the necessary attributes for the InsertCoalescer object.
+
+        Parameters
+        ----------
+        db : Database
+            the database the batches are written to
+        col_name : str
+            the collection the documents are inserted into
+        window : float
+            seconds a batch waits for more documents
+        max_batch : int
+            the number of documents that flushes a batch at once
+        """
+        self.db = db
+        self.col_name = col_name
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+    async def submit(self, document: dict) -> str:
+        """
+        Inserts a document as part of the next batch.
+
+        Parameters
+        ----------
+        document : dict
+            The document.
+
+        Returns
+        -------
+        str
+            The id of the inserted document.
+
+        Raises
+        ------
+        DuplicateError
+            If the document violates a unique index.
+        InsertError
+            If the document could not be inserted.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((document, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        """
+        Starts writing the waiting documents as one batch.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._write(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _write(self, batch: list[tuple[dict, asyncio.Future]]) -> None:
+        """
+        Writes a batch and hands every caller the result of its own document.
+        """
+        metrics.inc('insert_batches')
+        metrics.set('insert_batch_size', len(batch))
+        try:
+            results = await self.db.insert_many_unordered(self.col_name, [document for document, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
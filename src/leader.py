@@ -0,0 +1,185 @@
+import asyncio
+import datetime
+import logging
+import typing
+
+from src import config_reader
+from src.db_manager import db_manager, DbManager
+from src.exceptions import DuplicateError, MongoError
+from src.metrics import metrics
+
+
+class LeaderLease:
+    """
+    A class used to elect a single replica to run a task, through a lease stored in MongoDB.
+
+    ...
+
+    The lease is one document ``{'_id': name, 'holder', 'fence', 'expires_at'}`` in the
+    ``leases`` collection. The leader renews it every ``heartbeat`` seconds. Once it is
+    not renewed for ``ttl`` seconds any replica takes it over with a single conditional
+    update, which also increments the fencing token. A replica that fails to renew stops
+    its task at once, so failover takes at most ``ttl + heartbeat`` seconds.
+
+    The fencing token is stored on the documents the leader writes, and every write is
+    filtered with ``{'fence': {'$not': {'$gt': token}}}``. A deposed leader still holds
+    an older token, so its late writes match nothing once the new leader has touched a
+    document. The lease document is never deleted (no TTL index), so the token only
+    grows. Expiry uses the replicas' clocks, which are assumed to be NTP synchronised.
+
+    Attributes
+    ----------
+    db_manager : DbManager
+        a manager to interact with the database
+    name : str
+        the name of the lease
+    holder : str
+        the id of this replica
+    ttl : float
+        seconds a lease is valid without a heartbeat
+    heartbeat : float
+        seconds between two renewals
+    fence : int
+        the fencing token of this replica's lease, None while it is not the leader
+
+    Methods
+    -------
+    is_leader():
+        Tells whether this replica holds the lease.
+    tick():
+        Acquires or renews the lease once.
+    run(task):
+        Runs the task while this replica holds the lease, forever.
+    """
+    col_name = 'leases'
+
+    def __init__(self, db_man: DbManager, name: str, holder: str, ttl: float, heartbeat: float):
+        """
+        Constructs all the necessary attributes for the LeaderLease object.
+
+        Parameters
+        ----------
+        db_man : DbManager
+            a manager to interact with the database
+        name : str
+            the name of the lease
+        holder : str
+            the id of this replica
+        ttl : float
+            seconds a lease is valid without a heartbeat
+        heartbeat : float
+            seconds between two renewals
+        """
+        self.db_manager = db_man
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.fence: int | None = None
+        self._expires_at: datetime.datetime | None = None
+
+    def is_leader(self) -> bool:
+        """
+        Tells whether this replica holds a lease that has not expired.
+        """
+        return (self.fence is not None
+                and self._expires_at is not None
+                and self._expires_at > datetime.datetime.now(datetime.timezone.utc))
+
+    async def tick(self) -> bool:
+        """
+        Acquires or renews the lease once.
+
+        Returns
+        -------
+        bool
+            True if this replica holds the lease afterwards.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        expires_at = now + datetime.timedelta(seconds=self.ttl)
+        if self.fence is not None:
+            lease = await self.db_manager.find_one_and_update(
+                col_name=self.col_name,
+                fltr={'_id': self.name, 'holder': self.holder, 'fence': self.fence, 'expires_at': {'$gt': now}},
+                update={'$set': {'expires_at': expires_at}})
+            if lease:
+                self._expires_at = expires_at
+                return True
+            logging.warning(f'Lost the {self.name} lease with fence {self.fence}')
+            metrics.inc('leader_lost')
+            self.fence = None
+            self._expires_at = None
+
+        try:
+            await self.db_manager.update_one(col_name=self.col_name,
+                                             fltr={'_id': self.name},
+                                             update={'$setOnInsert': {'holder': None, 'fence': 0,
+                                                                      'expires_at': now}})
+        except DuplicateError:
+            pass  # another replica created it at the same moment
+        lease = await self.db_manager.find_one_and_update(
+            col_name=self.col_name,
+            fltr={'_id': self.name, 'expires_at': {'$lte': now}},
+            update={'$set': {'holder': self.holder, 'expires_at': expires_at}, '$inc': {'fence': 1}})
+        if not lease:
+            return False
+        self.fence = lease['fence']
+        self._expires_at = expires_at
+        logging.info(f'Acquired the {self.name} lease with fence {self.fence}')
+        metrics.inc('leader_acquired')
+        metrics.set('leader_fence', self.fence)
+        return True
+
+    async def run(self, task: typing.Callable[[int], typing.Awaitable[None]]) -> None:
+        """
+        Runs the task while this replica holds the lease, forever.
+
+        Parameters
+        ----------
+        task : typing.Callable
+            A coroutine function taking the fencing token, started on every acquisition
+            and cancelled when the lease is lost.
+        """
+        running: asyncio.Task | None = None
+        while True:
+            try:
+                leader = await self.tick()
+            except (MongoError, Exception):
+                logging.exception(f'Error in renewing the {self.name} lease')
+                leader = self.is_leader()
+            if leader and (running is None or running.done()):
+                running = asyncio.get_running_loop().create_task(task(self.fence))
+            elif not leader and running is not None:
+                running.cancel()
+                running = None
+            metrics.set('leader', int(leader))
+            await asyncio.sleep(self.heartbeat)
+
+
+def fenced(fltr: dict, update: dict, fence: int | None) -> tuple[dict, dict]:
+    """
+    Adds a fencing token to a write, so it is rejected once a newer leader wrote the document.
+
+    Parameters
+    ----------
+    fltr : dict
+        The filter of the write.
+    update : dict
+        The update of the write.
+    fence : int
+        The fencing token of the writer, None when leader election is off.
+
+    Returns
+    -------
+    tuple
+        The fenced filter and update.
+    """
+    if fence is None:
+        return fltr, update
+    return ({**fltr, 'fence': {'$not': {'$gt': fence}}},
+            {**update, '$set': {**update.get('$set', {}), 'fence': fence}})
+
+
+poller_lease = LeaderLease(db_manager, 'poller', config_reader.config.replica_id,
+                           ttl=config_reader.config.lease_ttl,
+                           heartbeat=config_reader.config.lease_heartbeat)
@@ -1,17 +1,28 @@
 import asyncio
+import datetime
 import logging
+from hypercorn.config import Config as HypercornConfig
+from hypercorn.run import run as run_hypercorn
+from pydantic import ValidationError
 from quart import Quart, jsonify, Response, request
 
 from src import config_reader
 from src.db_manager import db_manager
-from src.exceptions import TransactionManagerError, TonClientError, MongoError
-from model import Order
-from tr_manager import tr_manager
+from src.exceptions import TransactionManagerError, TonClientError, MongoError, OrderError, DuplicateError
+from src.model import Order, OrderStatus
+from src.value_id_allocator import value_id_allocator
+from src.sweeper import order_sweeper
+from src.metrics import metrics
+from src.indexes import INDEXES
+from src.scheduler import poll_scheduler
+from src.order_cache import order_cache
+from src.order_waiters import order_waiters
+from src.order_watcher import order_watcher
 
 app = Quart(__name__)
 logging.basicConfig(level=logging.DEBUG,
                     filename='../logs.log',
-                    filemode='w',
+                    filemode='a',
                     format='%(asctime)s - %(message)s')
 
 
@@ -19,9 +30,47 @@ logging.basicConfig(level=logging.DEBUG,
 async def startup():
     """
     Starts the application.
+
+    The poller is only imported outside of 'api' serve mode, importing it connects to the
+    liteservers.
     """
+    await db_manager.ensure_indexes(INDEXES)
     loop = asyncio.get_event_loop()
-    loop.create_task(main())
+    if config_reader.config.serve_mode != 'api':
+        from src.poller import run_poller
+        loop.create_task(run_poller())
+        if not config_reader.config.leader_election:
+            loop.create_task(order_sweeper.run(config_reader.config.sweep_interval))
+    if config_reader.config.order_change_stream:
+        loop.create_task(order_watcher.run())
+
+
+def serve():
+    """
+    Serves the API only, under hypercorn with API_WORKERS worker processes.
+
+    The poller and the sweeper run in their own process, started with ``src/poller.py``.
+    Confirmations and new orders only cross between the processes through the order
+    change stream, so ORDER_CHANGE_STREAM is required.
+    """
+    if not config_reader.config.order_change_stream:
+        raise SystemExit('SERVE_MODE=api requires ORDER_CHANGE_STREAM=true, '
+                         'the API processes would not see the orders confirmed by the poller')
+    hypercorn_config = HypercornConfig()
+    hypercorn_config.application_path = 'main:app'
+    hypercorn_config.bind = [f'0.0.0.0:{config_reader.config.app_port.get_secret_value()}']
+    hypercorn_config.workers = config_reader.config.api_workers
+    run_hypercorn(hypercorn_config)
+
+
+@app.after_serving
+async def shutdown():
+    """
+    Stops the application.
+    """
+    if config_reader.config.serve_mode != 'api':
+        from ton_client import client
+        await client.close()
 
 
 @app.route('/transactions', methods=['GET'])
@@ -36,12 +85,13 @@ async def on_get_transactions() -> Response:
     """
     try:
         data = await request.get_data()
-        invoice_id = data.decode()
+        try:
+            invoice_id = int(data.decode())
+        except ValueError:
+            return jsonify([])
 
-        order = await db_manager.get_one(col_name='orders',
-                                         fltr={'invoice_id': invoice_id})
+        order = await order_cache.get(invoice_id)
         if order:
-            order = Order.deserialize(order)
             return jsonify(order.to_dict())
         else:
             return jsonify([])
@@ -50,6 +100,45 @@ async def on_get_transactions() -> Response:
         logging.exception('Error in on_get_transactions')
 
 
+@app.route('/orders/<int:invoice_id>/wait', methods=['GET'])
+async def on_wait_order(invoice_id: int) -> Response:
+    """
+    Handles the GET request to the /orders/<invoice_id>/wait endpoint.
+
+    The request is held open until the status of the order differs from the ``status``
+    query parameter (``new`` by default) or ``timeout`` seconds pass, capped by
+    LONG_POLL_TIMEOUT. The order is read again before it is returned either way, since
+    another process may have changed it without waking this request.
+
+    Parameters
+    ----------
+    invoice_id : int
+        The invoice id.
+
+    Returns
+    -------
+    Response
+        The response to the GET request.
+    """
+    try:
+        known_status = request.args.get('status', OrderStatus.NEW.value)
+        timeout = min(request.args.get('timeout', config_reader.config.long_poll_timeout, type=float),
+                      config_reader.config.long_poll_timeout)
+        with order_waiters.subscribe(invoice_id) as changed:
+            order = await order_cache.get(invoice_id)
+            if not order:
+                return jsonify([])
+            if order.status == known_status:
+                try:
+                    await asyncio.wait_for(changed, timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+                order = await order_cache.get(invoice_id)
+        return jsonify(order.to_dict() if order else [])
+    except (MongoError, Exception):
+        logging.exception('Error in on_wait_order')
+
+
 @app.route('/create_order', methods=['POST'])
 async def on_create_order() -> Response:
     """
@@ -61,35 +150,148 @@ async def on_create_order() -> Response:
         The response to the POST request.
     """
     try:
-        invoice = Order.deserialize(await request.get_json())
-        orders_in_db_list = await db_manager.get_many('orders',
-                                                      {'value': invoice.value,
-                                                          'status': 'new'})
-        new_order = Order(invoice_id=invoice.invoice_id,
-                          value=invoice.value)
-        if not orders_in_db_list:
-            new_order.value_id = invoice.value
-        else:
-            orders_in_db = [Order.deserialize(order) for order in orders_in_db_list]
-            sorted_orders_in_db = sorted(orders_in_db,
-                                         key=lambda order: order.value_id,
-                                         reverse=True)
-
-            new_order.value_id = sorted_orders_in_db[0].value_id + 1
-        await db_manager.add_one('orders', new_order.serialize())
+        new_order = new_order_from(Order.deserialize(await request.get_json()))
+        await value_id_allocator.add_order(new_order)
+        order_cache.put(new_order)
+        poll_scheduler.notify()
         return jsonify(new_order.to_dict())
-    except (MongoError, TonClientError, TransactionManagerError, Exception):
+    except DuplicateError:
+        return jsonify({'error': 'invoice_id already exists'}), 409
+    except (MongoError, OrderError, TonClientError, TransactionManagerError, Exception):
         logging.exception('Error in on_create_order')
 
 
-async def main():
+@app.route('/orders/batch', methods=['POST'])
+async def on_create_orders() -> Response:
+    """
+    Handles the POST request to the /orders/batch endpoint.
+
+    The body is ``{"orders": [{"invoice_id": ..., "value": ...}, ...]}`` with at most
+    MAX_BATCH_SIZE orders. A batch with an invalid order or a repeated invoice id is
+    rejected as a whole. Value ids are allocated per value and all orders are inserted
+    with one bulk write.
+
+    Returns
+    -------
+    Response
+        The created order or an error, keyed by invoice id.
     """
-    The main loop of the application.
+    try:
+        body = await request.get_json(silent=True)
+        items = body.get('orders') if isinstance(body, dict) else None
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'orders must be a non-empty list'}), 400
+        if len(items) > config_reader.config.max_batch_size:
+            return jsonify({'error': f'at most {config_reader.config.max_batch_size} orders per batch'}), 400
+
+        results = {}
+        seen = set()
+        new_orders = []
+        for index, item in enumerate(items):
+            try:
+                invoice = Order.deserialize(item)
+            except (ValidationError, TypeError):
+                return jsonify({'error': f'order at index {index} is invalid'}), 400
+            if invoice.invoice_id in seen:
+                return jsonify({'error': f'invoice_id {invoice.invoice_id} appears more than once'}), 400
+            seen.add(invoice.invoice_id)
+            new_orders.append(new_order_from(invoice))
+
+        if new_orders:
+            stored = await value_id_allocator.add_orders(new_orders)
+            for order, result in zip(new_orders, stored):
+                if isinstance(result, DuplicateError):
+                    results[str(order.invoice_id)] = {'error': 'invoice_id already exists'}
+                elif isinstance(result, Exception):
+                    logging.error(f'Failed to store order {order.invoice_id}: {result}')
+                    results[str(order.invoice_id)] = {'error': 'order not stored'}
+                else:
+                    order_cache.put(order)
+                    results[str(order.invoice_id)] = order.to_dict()
+            poll_scheduler.notify()
+        return jsonify(results)
+    except (MongoError, OrderError, Exception):
+        logging.exception('Error in on_create_orders')
+
+
+@app.route('/orders/status', methods=['POST'])
+async def on_get_orders_status() -> Response:
+    """
+    Handles the POST request to the /orders/status endpoint.
+
+    The body is ``{"invoice_ids": [...]}`` with at most MAX_BATCH_SIZE invoice ids. Ids
+    missing from the order cache are read with a single ``$in`` query.
+
+    Returns
+    -------
+    Response
+        The order, or null if there is none, keyed by invoice id.
+    """
+    try:
+        body = await request.get_json(silent=True)
+        invoice_ids = body.get('invoice_ids') if isinstance(body, dict) else None
+        if (not isinstance(invoice_ids, list) or not invoice_ids
+                or not all(isinstance(invoice_id, int) and not isinstance(invoice_id, bool)
+                           for invoice_id in invoice_ids)):
+            return jsonify({'error': 'invoice_ids must be a non-empty list of integers'}), 400
+        if len(invoice_ids) > config_reader.config.max_batch_size:
+            return jsonify({'error': f'at most {config_reader.config.max_batch_size} invoice ids per request'}), 400
+
+        orders = await order_cache.get_many(invoice_ids)
+        return jsonify({str(invoice_id): order.to_dict() if order else None
+                        for invoice_id, order in orders.items()})
+    except (MongoError, Exception):
+        logging.exception('Error in on_get_orders_status')
+
+
+def new_order_from(invoice: Order) -> Order:
+    """
+    Builds a NEW order for an incoming invoice, with its expiry time.
+
+    Parameters
+    ----------
+    invoice : Order
+        The invoice sent by the client.
+
+    Returns
+    -------
+    Order
+        The new order without a value id.
+    """
+    expires_at = None
+    if config_reader.config.order_ttl:
+        expires_at = (datetime.datetime.now(datetime.timezone.utc)
+                      + datetime.timedelta(seconds=config_reader.config.order_ttl))
+    return Order(invoice_id=invoice.invoice_id,
+                 value=invoice.value,
+                 expires_at=expires_at)
+
+
+@app.route('/metrics', methods=['GET'])
+async def on_get_metrics() -> Response:
+    """
+    Handles the GET request to the /metrics endpoint.
+
+    In 'api' serve mode the metrics published by the poller processes are added under
+    ``pollers``, keyed by replica id.
+
+    Returns
+    -------
+    Response
+        The current service metrics.
     """
-    while True:
-        await tr_manager.check_transactions_in_bc()
-        await asyncio.sleep(60)
+    snapshot = metrics.snapshot()
+    if config_reader.config.serve_mode == 'api':
+        try:
+            snapshot['pollers'] = {document['_id']: document['snapshot'] | {'updated_at': document['updated_at']}
+                                   for document in await db_manager.get_many(col_name='metrics')}
+        except (MongoError, Exception):
+            logging.exception('Error in reading the poller metrics')
+    return jsonify(snapshot)
 
 
 if __name__ == '__main__':
-    app.run(port=config_reader.config.app_port.get_secret_value())
+    if config_reader.config.serve_mode == 'api':
+        serve()
+    else:
+        app.run(port=config_reader.config.app_port.get_secret_value())
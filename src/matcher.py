@@ -0,0 +1,91 @@
+from collections import defaultdict, deque
+
+from src.model import OrderRow, TransactionRecord
+
+
+class OrderMatcher:
+    """
+    A class used to match incoming transactions against pending orders.
+
+    ...
+
+    Orders are indexed by ``invoice_id`` and by ``value_id`` once, every transaction is
+    then resolved with dict lookups, so matching costs O(transactions) whatever the number
+    of orders. A transaction whose comment is the invoice id of a pending order pays that
+    order if it carries at least the order value. Otherwise the transaction value is
+    looked up as a ``value_id``.
+
+    Each transaction pays for at most one order and each order is paid at most once:
+    when several transactions carry the same value, they consume the pending orders
+    with that ``value_id`` oldest first, in the order the transactions happened.
+
+    Methods
+    -------
+    invoice_id_from_comment(comment):
+        Extracts the invoice id a transaction comment refers to.
+    match(orders, transactions):
+        Pairs pending orders with the transactions that paid them.
+    """
+    @staticmethod
+    def invoice_id_from_comment(comment: str | None) -> int | None:
+        """
+        Extracts the invoice id a transaction comment refers to.
+
+        Parameters
+        ----------
+        comment : str
+            The transaction comment.
+
+        Returns
+        -------
+        int
+            The invoice id, None if the comment is not an invoice id.
+        """
+        if not comment:
+            return None
+        comment = comment.strip()
+        if not comment.isdigit():
+            return None
+        return int(comment)
+
+    def match(self, orders: list[OrderRow],
+              transactions: list[TransactionRecord]) -> list[tuple[OrderRow, TransactionRecord]]:
+        """
+        Pairs pending orders with the transactions that paid them.
+
+        Parameters
+        ----------
+        orders : list
+            Pending orders, oldest first.
+        transactions : list
+            New transactions, in any order.
+
+        Returns
+        -------
+        list
+            A list of (order, transaction) pairs.
+        """
+        by_invoice_id: dict[int, OrderRow] = {}
+        by_value_id: dict[int, deque[OrderRow]] = defaultdict(deque)
+        for order in orders:
+            by_invoice_id[order.invoice_id] = order
+            by_value_id[order.value_id].append(order)
+
+        matches = []
+        paid: set[int] = set()
+        for transaction in sorted(transactions, key=lambda tr: tr.lt):
+            order = by_invoice_id.get(self.invoice_id_from_comment(transaction.comment))
+            if order is None or order.invoice_id in paid or transaction.value < order.value:
+                order = None
+                pending = by_value_id.get(transaction.value)
+                while pending and pending[0].invoice_id in paid:
+                    pending.popleft()
+                if pending:
+                    order = pending.popleft()
+            if order is not None:
+                paid.add(order.invoice_id)
+                matches.append((order, transaction))
+        return matches
+
+
+order_matcher = OrderMatcher()
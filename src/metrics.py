@@ -0,0 +1,82 @@
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    A class used to collect in-process service metrics.
+
+    ...
+
+    Attributes
+    ----------
+    counters : dict
+        monotonically increasing values
+    gauges : dict
+        values that reflect the current state
+    timings : dict
+        count, total, last and max duration of timed operations in seconds
+
+    Methods
+    -------
+    inc(name, value=1):
+        Increments a counter.
+    set(name, value):
+        Sets a gauge.
+    observe(name, seconds):
+        Records the duration of an operation.
+    timer(name):
+        Context manager that records the duration of its block.
+    snapshot():
+        Returns all metrics as a dictionary.
+    """
+    def __init__(self):
+        self.counters: dict[str, int] = {}
+        self.gauges: dict[str, float] = {}
+        self.timings: dict[str, dict[str, float]] = {}
+
+    def inc(self, name: str, value: int = 1) -> None:
+        """
+        Increments a counter.
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float) -> None:
+        """
+        Sets a gauge.
+        """
+        self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        Records the duration of an operation.
+        """
+        timing = self.timings.setdefault(name, {'count': 0, 'total': 0.0, 'last': 0.0, 'max': 0.0})
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['last'] = seconds
+        timing['max'] = max(timing['max'], seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """
+        Context manager that records the duration of its block.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started)
+
+    def snapshot(self) -> dict:
+        """
+        Returns all metrics as a dictionary.
+        """
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'timings': {name: dict(timing) for name, timing in self.timings.items()}
+        }
+
+
+metrics = Metrics()
@@ -1,13 +1,15 @@
 import datetime
 from enum import Enum
 
-from pydantic import BaseModel
-from pytoniq_core import Transaction
+from pydantic import BaseModel, field_validator
+from pytoniq_core import Cell, Transaction
 
 
 class Model(BaseModel):
     """
     A base class that provides serialization and deserialization methods for models.
+
+    ``projection`` lets reads fetch only the model fields instead of whole documents.
     """
     def serialize(self) -> dict:
         """
@@ -37,6 +39,18 @@ class Model(BaseModel):
         """
         return cls(**serialized_data)
 
+    @classmethod
+    def projection(cls) -> dict:
+        """
+        Returns the projection that reads only the fields of the model.
+
+        Returns
+        -------
+        dict
+            The MongoDB projection.
+        """
+        return {'_id': 0, **{name: 1 for name in cls.model_fields}}
+
 
 class OrderStatus(Enum):
     """
@@ -57,21 +71,30 @@ class TransactionRecord(Model):
         The logical time of the transaction.
     timestamp : str
         The timestamp of the transaction.
+    hash : str
+        The hex encoded hash of the transaction.
     value : int
         The value of the transaction.
     from_address : str
         The source address of the transaction.
+    address : str
+        The watched address that received the transaction.
+    comment : str
+        The text comment of the inbound message, None if it carries no comment.
     """
     lt: int = -1
+    hash: str = ''
     timestamp: str = ''
     value: int
     from_address: str | None = None
+    address: str | None = None
+    comment: str | None = None
 
     class Config:
         use_enum_values = True
 
     @classmethod
-    def from_transaction(cls, transaction: Transaction) -> 'TransactionRecord':
+    def from_transaction(cls, transaction: Transaction, address: str | None = None) -> 'TransactionRecord':
         """
         Creates a TransactionRecord instance from a Transaction instance.
 
@@ -79,6 +102,8 @@ class TransactionRecord(Model):
         ----------
         transaction : Transaction
             The transaction instance.
+        address : str, optional
+            The watched address the transaction was fetched for.
 
         Returns
         -------
@@ -87,9 +112,41 @@ class TransactionRecord(Model):
         """
         return cls(
             lt=transaction.lt,
+            hash=transaction.cell.hash.hex(),
             timestamp=str(transaction.now),  # Assuming 'now' is the creation date in Unix timestamp
             value=transaction.in_msg.info.value_coins,  # Assuming 'value_coins' is the value
-            from_address=transaction.in_msg.info.src.to_str())  # Assuming 'src' is the source address
+            from_address=transaction.in_msg.info.src.to_str(),  # Assuming 'src' is the source address
+            address=address,
+            comment=cls.parse_comment(transaction.in_msg.body))
+
+    @staticmethod
+    def parse_comment(body: Cell | None) -> str | None:
+        """
+        Parses the text comment of a message body.
+
+        A text comment is a body starting with a 32 bit zero op code, followed by the
+        UTF-8 text stored as a snake string.
+
+        Parameters
+        ----------
+        body : Cell
+            The message body.
+
+        Returns
+        -------
+        str
+            The comment, None if the body is not a valid text comment.
+        """
+        if body is None:
+            return None
+        try:
+            body_slice = body.begin_parse()
+            if body_slice.remaining_bits < 32 or body_slice.load_uint(32) != 0:
+                return None
+            return body_slice.load_snake_string()
+        except Exception:
+            # a malformed snake string fails an assertion in pytoniq_core, not only the decoding
+            return None
 
     def to_dict(self) -> dict:
         """
@@ -102,12 +159,63 @@ class TransactionRecord(Model):
         """
         return {
             'lt': self.lt,
+            'hash': self.hash,
             'timestamp': self.timestamp,
             'value': self.value,
-            'from_address': self.from_address
+            'from_address': self.from_address,
+            'address': self.address,
+            'comment': self.comment
         }
 
 
+class Checkpoint(Model):
+    """
+    Represents the position of the newest stored transaction of a watched address.
+
+    Attributes
+    ----------
+    address : str
+        The watched address.
+    lt : int
+        The logical time of the newest stored transaction.
+    hash : str
+        The hex encoded hash of the newest stored transaction.
+    """
+    address: str
+    lt: int
+    hash: str = ''
+
+
+class TransactionPage:
+    """
+    One page of new transactions of a watched address, as fetched from the chain.
+
+    ...
+
+    Only transactions with an internal inbound message are decoded, but ``newest`` points
+    at the newest raw transaction of the page whatever its kind, so the checkpoint also
+    moves past outgoing and external transactions.
+
+    Attributes
+    ----------
+    transactions : list
+        The decoded transactions of the page.
+    newest : Checkpoint
+        The position of the newest raw transaction of the page.
+    """
+    __slots__ = ('transactions', 'newest')
+
+    def __init__(self, transactions: list[TransactionRecord], newest: Checkpoint):
+        """
+        Constructs all the necessary attributes for the TransactionPage object.
+        """
+        self.transactions = transactions
+        self.newest = newest
+
+    def __repr__(self) -> str:
+        return f'TransactionPage(transactions={self.transactions!r}, newest={self.newest!r})'
+
+
 class Order(Model):
     """
     Represents an order with attributes like invoice id, value, value id, and status.
@@ -122,11 +230,28 @@ class Order(Model):
         The value id of the order.
     status : str
         The status of the order.
+    expires_at : datetime.datetime
+        The moment a NEW order is canceled, None if it never expires.
     """
     invoice_id: int
     value: int
     value_id: int = 0
     status: str = OrderStatus.NEW.value
+    expires_at: datetime.datetime | None = None
+
+    @field_validator('expires_at')
+    @classmethod
+    def expires_at_in_utc(cls, expires_at: datetime.datetime | None) -> datetime.datetime | None:
+        """
+        Keeps the expiry time as MongoDB stores it, in UTC and to the millisecond, so a
+        cached order and one read back from the database look the same. A naive time is UTC.
+        """
+        if expires_at is None:
+            return None
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+        expires_at = expires_at.astimezone(datetime.timezone.utc)
+        return expires_at.replace(microsecond=expires_at.microsecond // 1000 * 1000)
 
     def to_dict(self) -> dict:
         """
@@ -141,6 +266,87 @@ class Order(Model):
             'invoice_id': self.invoice_id,
             'value': self.value,
             'value_id': self.value_id,
-            'status': self.status
+            'status': self.status,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None
         }
 
+
+class OrderRow:
+    """
+    A lightweight order read from our own database, used where many orders are scanned.
+
+    ...
+
+    The documents were written through ``Order.serialize`` and are trusted, so they are
+    not validated again. A ``__slots__`` class is several times cheaper to build than a
+    pydantic model, even one built with ``model_construct``.
+
+    Attributes
+    ----------
+    invoice_id : int
+        The invoice id of the order.
+    value : int
+        The value of the order.
+    value_id : int
+        The value id of the order.
+    status : str
+        The status of the order.
+    expires_at : datetime.datetime
+        The moment a NEW order is canceled, None if it never expires.
+
+    Methods
+    -------
+    from_db(document):
+        Builds a row from an orders document.
+    projection():
+        Returns the projection that reads only the order fields.
+    """
+    __slots__ = ('invoice_id', 'value', 'value_id', 'status', 'expires_at')
+
+    def __init__(self, invoice_id: int, value: int, value_id: int = 0, status: str = OrderStatus.NEW.value,
+                 expires_at: datetime.datetime | None = None):
+        """
+        Constructs all the necessary attributes for the OrderRow object.
+        """
+        self.invoice_id = invoice_id
+        self.value = value
+        self.value_id = value_id
+        self.status = status
+        self.expires_at = expires_at
+
+    def __repr__(self) -> str:
+        return (f'OrderRow(invoice_id={self.invoice_id!r}, value={self.value!r}, value_id={self.value_id!r}, '
+                f'status={self.status!r}, expires_at={self.expires_at!r})')
+
+    @classmethod
+    def from_db(cls, document: dict) -> 'OrderRow':
+        """
+        Builds a row from an orders document.
+
+        Parameters
+        ----------
+        document : dict
+            The orders document, extra keys like ``_id`` are ignored.
+
+        Returns
+        -------
+        OrderRow
+            The order row.
+        """
+        return cls(document['invoice_id'],
+                   document['value'],
+                   document.get('value_id', 0),
+                   document.get('status', OrderStatus.NEW.value),
+                   document.get('expires_at'))
+
+    @classmethod
+    def projection(cls) -> dict:
+        """
+        Returns the projection that reads only the order fields.
+
+        Returns
+        -------
+        dict
+            The MongoDB projection.
+        """
+        return {'_id': 0, **{name: 1 for name in cls.__slots__}}
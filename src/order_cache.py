@@ -0,0 +1,246 @@
+import time
+from collections import OrderedDict
+
+from src import config_reader
+from src.db_manager import db_manager, DbManager
+from src.metrics import metrics
+from src.model import Order
+
+
+class OrderCache:
+    """
+    A read-through LRU cache of orders by invoice id, in front of the orders collection.
+
+    ...
+
+    Found orders are kept for ``ttl`` seconds, unknown invoice ids for ``negative_ttl``
+    seconds, and the least recently used entry is evicted once ``max_size`` entries are
+    held. The service drops an entry whenever it confirms or cancels the order and
+    stores new orders directly, so within one process a cached status is never stale.
+    A database read that overlaps a change of its invoice is returned but not cached, so
+    a read started before the change cannot store the state it replaced. The TTL bounds
+    staleness caused by other processes writing to the same database, unless the order
+    change watcher feeds their writes into the cache.
+
+    Attributes
+    ----------
+    db_manager : DbManager
+        a manager to interact with the database
+    max_size : int
+        the number of cached invoice ids
+    ttl : float
+        seconds a found order is cached
+    negative_ttl : float
+        seconds an unknown invoice id is cached
+
+    Methods
+    -------
+    get(invoice_id):
+        Returns the order of an invoice, reading through to the database on a miss.
+    get_many(invoice_ids):
+        Returns the orders of many invoices, reading all misses with one query.
+    put(order):
+        Caches an order.
+    invalidate(invoice_id):
+        Drops the cached entry of an invoice.
+    clear():
+        Drops every cached entry.
+    """
+    def __init__(self, db_man: DbManager, max_size: int, ttl: float, negative_ttl: float):
+        """
+        Constructs all the necessary attributes for the OrderCache object.
+
+        Parameters
+        ----------
+        db_man : DbManager
+            a manager to interact with the database
+        max_size : int
+            the number of cached invoice ids
+        ttl : float
+            seconds a found order is cached
+        negative_ttl : float
+            seconds an unknown invoice id is cached
+        """
+        self.db_manager = db_man
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: OrderedDict[int, tuple[float, Order | None]] = OrderedDict()
+        self._reading: dict[int, int] = {}
+        self._changed: set[int] = set()
+        self._hits = 0
+        self._lookups = 0
+
+    async def get(self, invoice_id: int) -> Order | None:
+        """
+        Returns the order of an invoice, reading through to the database on a miss.
+
+        Parameters
+        ----------
+        invoice_id : int
+            The invoice id.
+
+        Returns
+        -------
+        Order
+            The order, None if there is no order with this invoice id.
+
+        Raises
+        ------
+        GetOneError
+            If the order cannot be read from the database.
+        """
+        self._lookups += 1
+        entry = self._entries.get(invoice_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(invoice_id)
+            self._hits += 1
+            metrics.inc('order_cache_hits')
+            if entry[1] is None:
+                metrics.inc('order_cache_negative_hits')
+            metrics.set('order_cache_hit_rate', self._hits / self._lookups)
+            return entry[1]
+
+        metrics.inc('order_cache_misses')
+        metrics.set('order_cache_hit_rate', self._hits / self._lookups)
+        self._begin_read([invoice_id])
+        try:
+            document = await self.db_manager.get_one(col_name='orders',
+                                                     fltr={'invoice_id': invoice_id},
+                                                     projection=Order.projection())
+        finally:
+            unchanged = self._end_read([invoice_id])
+        order = Order.deserialize(document) if document else None
+        if invoice_id in unchanged:
+            self._store(invoice_id, order)
+        return order
+
+    async def get_many(self, invoice_ids: list[int]) -> dict[int, Order | None]:
+        """
+        Returns the orders of many invoices, reading all misses with one query.
+
+        Parameters
+        ----------
+        invoice_ids : list
+            The invoice ids.
+
+        Returns
+        -------
+        dict
+            The order of every invoice id, None if there is no order with this invoice id.
+
+        Raises
+        ------
+        GetManyError
+            If the orders cannot be read from the database.
+        """
+        now = time.monotonic()
+        orders: dict[int, Order | None] = {}
+        misses = []
+        for invoice_id in dict.fromkeys(invoice_ids):
+            entry = self._entries.get(invoice_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(invoice_id)
+                orders[invoice_id] = entry[1]
+            else:
+                misses.append(invoice_id)
+        self._lookups += len(orders) + len(misses)
+        self._hits += len(orders)
+        metrics.inc('order_cache_hits', len(orders))
+        metrics.inc('order_cache_misses', len(misses))
+        if self._lookups:
+            metrics.set('order_cache_hit_rate', self._hits / self._lookups)
+
+        if misses:
+            self._begin_read(misses)
+            try:
+                documents = await self.db_manager.get_many(col_name='orders',
+                                                           fltr={'invoice_id': {'$in': misses}},
+                                                           projection=Order.projection())
+            finally:
+                unchanged = self._end_read(misses)
+            found = {document['invoice_id']: Order.deserialize(document) for document in documents}
+            for invoice_id in misses:
+                orders[invoice_id] = found.get(invoice_id)
+                if invoice_id in unchanged:
+                    self._store(invoice_id, orders[invoice_id])
+        return orders
+
+    def put(self, order: Order) -> None:
+        """
+        Caches an order.
+
+        Parameters
+        ----------
+        order : Order
+            The order as stored in the database.
+        """
+        self._mark_changed(order.invoice_id)
+        self._store(order.invoice_id, order)
+
+    def invalidate(self, invoice_id: int) -> None:
+        """
+        Drops the cached entry of an invoice.
+
+        Parameters
+        ----------
+        invoice_id : int
+            The invoice id.
+        """
+        self._mark_changed(invoice_id)
+        self._entries.pop(invoice_id, None)
+
+    def clear(self) -> None:
+        """
+        Drops every cached entry.
+        """
+        self._changed.update(self._reading)
+        self._entries.clear()
+        metrics.set('order_cache_size', 0)
+
+    def _mark_changed(self, invoice_id: int) -> None:
+        """
+        Keeps the database reads in flight for an invoice from caching their result.
+        """
+        if invoice_id in self._reading:
+            self._changed.add(invoice_id)
+
+    def _begin_read(self, invoice_ids: list[int]) -> None:
+        """
+        Registers a database read of invoices.
+        """
+        for invoice_id in invoice_ids:
+            self._reading[invoice_id] = self._reading.get(invoice_id, 0) + 1
+
+    def _end_read(self, invoice_ids: list[int]) -> set[int]:
+        """
+        Unregisters a database read of invoices and returns the ones not changed during it.
+        """
+        unchanged = set()
+        for invoice_id in invoice_ids:
+            count = self._reading.pop(invoice_id) - 1
+            if count:
+                self._reading[invoice_id] = count
+            if invoice_id not in self._changed:
+                unchanged.add(invoice_id)
+            elif not count:
+                self._changed.discard(invoice_id)
+        return unchanged
+
+    def _store(self, invoice_id: int, order: Order | None) -> None:
+        """
+        Stores an entry and evicts the least recently used ones above max_size.
+        """
+        ttl = self.ttl if order is not None else self.negative_ttl
+        self._entries[invoice_id] = (time.monotonic() + ttl, order)
+        self._entries.move_to_end(invoice_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            metrics.inc('order_cache_evictions')
+        metrics.set('order_cache_size', len(self._entries))
+
+
+order_cache = OrderCache(db_manager,
+                         max_size=config_reader.config.order_cache_size,
+                         ttl=config_reader.config.order_cache_ttl,
+                         negative_ttl=config_reader.config.order_cache_negative_ttl)
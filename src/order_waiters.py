@@ -0,0 +1,72 @@
+import asyncio
+from contextlib import contextmanager
+
+from src.metrics import metrics
+
+
+class OrderWaiters:
+    """
+    A registry of requests waiting for the status of an order to change.
+
+    ...
+
+    A request subscribes to an invoice id before reading the order, so a change that
+    happens between the read and the wait is not missed. Whoever changes the status of
+    an order calls ``notify`` and every subscriber of that invoice id wakes up.
+
+    Methods
+    -------
+    subscribe(invoice_id):
+        Context manager yielding a future that resolves with the new status.
+    notify(invoice_id, status):
+        Wakes every request waiting on an invoice id.
+    """
+    def __init__(self):
+        """
+        Constructs all the necessary attributes for the OrderWaiters object.
+        """
+        self._waiters: dict[int, set[asyncio.Future]] = {}
+        self._count = 0
+
+    @contextmanager
+    def subscribe(self, invoice_id: int):
+        """
+        Context manager yielding a future that resolves with the new status of the order.
+
+        Parameters
+        ----------
+        invoice_id : int
+            The invoice id.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(invoice_id, set()).add(future)
+        self._count += 1
+        metrics.set('order_waiters', self._count)
+        try:
+            yield future
+        finally:
+            waiters = self._waiters.get(invoice_id)
+            if waiters is not None:
+                waiters.discard(future)
+                if not waiters:
+                    del self._waiters[invoice_id]
+            self._count -= 1
+            metrics.set('order_waiters', self._count)
+
+    def notify(self, invoice_id: int, status: str) -> None:
+        """
+        Wakes every request waiting on an invoice id.
+
+        Parameters
+        ----------
+        invoice_id : int
+            The invoice id.
+        status : str
+            The new status of the order.
+        """
+        for future in self._waiters.get(invoice_id, ()):
+            if not future.done():
+                future.set_result(status)
+
+
+order_waiters = OrderWaiters()
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+
+from src.db_manager import db_manager, DbManager
+from src.exceptions import WatchError
+from src.metrics import metrics
+from src.model import Order, OrderStatus
+from src.order_cache import order_cache, OrderCache
+from src.order_waiters import order_waiters, OrderWaiters
+from src.scheduler import poll_scheduler, PollScheduler
+
+# server error codes of a change stream that cannot be resumed from its token
+HISTORY_LOST_CODES = (280, 286)
+# the server is not a replica set, change streams are not available
+NOT_REPLICA_SET_CODE = 40573
+
+
+class OrderChangeWatcher:
+    """
+    A class used to push status changes of orders written by any replica into this one.
+
+    ...
+
+    The watcher follows a change stream on the orders collection. Every inserted order
+    and every status update is written into the local order cache and wakes the local
+    waiters, so status reads stay in memory on every replica and long-polls return as
+    soon as any replica confirms or cancels the order. An inserted order also wakes the
+    local poll scheduler, so a poller running apart from the API notices new orders.
+
+    The resume token is only kept in memory and the stream resumes from it after a
+    reconnect. Every process, e.g. each hypercorn worker, starts its stream from now: its
+    cache and waiters start empty, so there is nothing to replay, and the poller checks
+    every address on its first cycle anyway. If the token fell off the oplog the cache is
+    cleared and the stream starts from now.
+
+    Attributes
+    ----------
+    db_manager : DbManager
+        a manager to interact with the database
+    cache : OrderCache
+        the cache updated with every change
+    waiters : OrderWaiters
+        the registry notified of every status change
+    scheduler : PollScheduler
+        the scheduler woken by every new order
+    retry_delay : float
+        seconds to wait before reopening a failed stream
+
+    Methods
+    -------
+    run():
+        Follows the change stream forever.
+    """
+    pipeline = [{'$match': {'$or': [{'operationType': {'$in': ['insert', 'replace', 'invalidate']}},
+                                    {'operationType': 'update',
+                                     'updateDescription.updatedFields.status': {'$exists': True}}]}}]
+
+    def __init__(self, db_man: DbManager, cache: OrderCache, waiters: OrderWaiters, scheduler: PollScheduler,
+                 retry_delay: float = 5):
+        """
+        Constructs all the necessary attributes for the OrderChangeWatcher object.
+
+        Parameters
+        ----------
+        db_man : DbManager
+            a manager to interact with the database
+        cache : OrderCache
+            the cache updated with every change
+        waiters : OrderWaiters
+            the registry notified of every status change
+        scheduler : PollScheduler
+            the scheduler woken by every new order
+        retry_delay : float, optional
+            seconds to wait before reopening a failed stream
+        """
+        self.db_manager = db_man
+        self.cache = cache
+        self.waiters = waiters
+        self.scheduler = scheduler
+        self.retry_delay = retry_delay
+
+    async def run(self) -> None:
+        """
+        Follows the change stream forever.
+        """
+        token = None
+        while True:
+            try:
+                async for change in self.db_manager.watch('orders', self.pipeline, resume_after=token):
+                    if change['operationType'] == 'invalidate':
+                        token = None
+                        break
+                    self._apply(change)
+                    token = change['_id']
+            except WatchError as e:
+                if e.code == NOT_REPLICA_SET_CODE:
+                    logging.error('Change streams need a replica set, the order change watcher is stopped')
+                    return
+                if e.code in HISTORY_LOST_CODES:
+                    logging.warning('The resume token is no longer in the oplog, restarting the order stream')
+                    token = None
+                    self.cache.clear()
+                metrics.inc('order_watch_restarts')
+                await asyncio.sleep(self.retry_delay)
+            except Exception:
+                logging.exception('Error in watching orders')
+                metrics.inc('order_watch_restarts')
+                await asyncio.sleep(self.retry_delay)
+
+    def _apply(self, change: dict) -> None:
+        """
+        Writes a changed order into the cache and wakes its waiters, or the scheduler for a new order.
+        """
+        document = change.get('fullDocument')
+        if not document:
+            return
+        order = Order.deserialize(document)
+        self.cache.put(order)
+        if order.status != OrderStatus.NEW.value:
+            self.waiters.notify(order.invoice_id, order.status)
+        elif change['operationType'] == 'insert':
+            self.scheduler.notify()
+        metrics.inc('order_changes')
+
+
+order_watcher = OrderChangeWatcher(db_manager, order_cache, order_waiters, poll_scheduler)
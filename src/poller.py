@@ -0,0 +1,99 @@
+import asyncio
+import datetime
+import logging
+
+from src import config_reader
+from src.db_manager import db_manager
+from src.exceptions import MongoError
+from src.indexes import INDEXES
+from src.metrics import metrics
+from src.order_watcher import order_watcher
+from src.scheduler import poll_scheduler
+from src.block_scanner import block_scanner
+from src.sweeper import order_sweeper
+from src.leader import poller_lease
+from tr_manager import tr_manager
+from ton_client import client
+
+
+async def run_poller():
+    """
+    The poll loop, run by the replica holding the poller lease when leader election is on.
+    """
+    if config_reader.config.leader_election:
+        await poller_lease.run(lead)
+    else:
+        await poll()
+
+
+async def lead(fence: int):
+    """
+    Runs the poller and the expired order sweeper while this replica holds the poller lease.
+
+    Parameters
+    ----------
+    fence : int
+        The fencing token of the lease.
+    """
+    tr_manager.fence = fence
+    order_sweeper.fence = fence
+    await asyncio.gather(poll(), order_sweeper.run(config_reader.config.sweep_interval))
+
+
+async def poll():
+    """
+    Polls the blockchain for payments in the configured watch mode.
+    """
+    if config_reader.config.watch_mode == 'subscribe':
+        await poll_scheduler.run(tr_manager.check_transactions_in_bc, tr_manager.wait_for_new_transactions)
+    elif config_reader.config.watch_mode == 'block_scan':
+        await poll_scheduler.run(block_scanner.scan)
+    else:
+        await poll_scheduler.run(tr_manager.check_transactions_in_bc)
+
+
+async def publish_metrics(interval: float):
+    """
+    Stores the metrics of this process in the ``metrics`` collection every ``interval`` seconds.
+
+    The API serves them on GET /metrics next to its own.
+    """
+    while True:
+        try:
+            await db_manager.update_one(col_name='metrics',
+                                        fltr={'_id': config_reader.config.replica_id},
+                                        update={'$set': {'snapshot': metrics.snapshot(),
+                                                         'updated_at': datetime.datetime.now(datetime.timezone.utc)}})
+        except (MongoError, Exception):
+            logging.exception('Error in publishing the poller metrics')
+        await asyncio.sleep(interval)
+
+
+async def main():
+    """
+    Runs the poller and the expired order sweeper without the HTTP API.
+
+    With ORDER_CHANGE_STREAM the order change watcher runs as well, so orders created by
+    the API processes wake the poller.
+    """
+    await db_manager.ensure_indexes(INDEXES)
+    loop = asyncio.get_running_loop()
+    tasks = [loop.create_task(publish_metrics(config_reader.config.poller_metrics_interval))]
+    if not config_reader.config.leader_election:
+        tasks.append(loop.create_task(order_sweeper.run(config_reader.config.sweep_interval)))
+    if config_reader.config.order_change_stream:
+        tasks.append(loop.create_task(order_watcher.run()))
+    try:
+        await run_poller()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await client.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG,
+                        filename='../poller.log',
+                        filemode='w',
+                        format='%(asctime)s - %(message)s')
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+import typing
+
+from src import config_reader
+from src.db_manager import db_manager, DbManager
+from src.metrics import metrics
+from src.model import OrderStatus
+
+
+class PollScheduler:
+    """
+    A class used to decide when the next poll cycle runs.
+
+    ...
+
+    While NEW orders exist or the last cycle found transactions, cycles run every
+    ``min_interval`` seconds. Otherwise the interval doubles after every idle cycle up to
+    ``max_interval``. ``notify()`` wakes the scheduler at once and resets the interval, it
+    is called whenever an order is created.
+
+    When a ``wait_for_change`` coroutine is given, the scheduler waits on it between cycles
+    instead of sleeping, so a cycle only runs once the chain reports a change (or
+    ``max_interval`` passed). After a failed cycle, or if waiting fails, the scheduler falls
+    back to plain polling for that round.
+
+    Attributes
+    ----------
+    db_manager : DbManager
+        a manager to interact with the database
+    min_interval : float
+        the interval while there is work to do
+    max_interval : float
+        the longest interval when idle
+    backoff : float
+        the factor applied to the interval after an idle cycle
+    interval : float
+        the current interval
+
+    Methods
+    -------
+    notify():
+        Wakes the scheduler and resets the interval.
+    run(poll, wait_for_change=None):
+        Runs the poll coroutine forever.
+    """
+    def __init__(self, db_man: DbManager, min_interval: float, max_interval: float, backoff: float = 2):
+        """
+        Constructs all the necessary attributes for the PollScheduler object.
+
+        Parameters
+        ----------
+        db_man : DbManager
+            a manager to interact with the database
+        min_interval : float
+            the interval while there is work to do
+        max_interval : float
+            the longest interval when idle
+        backoff : float, optional
+            the factor applied to the interval after an idle cycle
+        """
+        self.db_manager = db_man
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self._wake = asyncio.Event()
+        self._last_cycle: float | None = None
+
+    def notify(self) -> None:
+        """
+        Wakes the scheduler and resets the interval.
+        """
+        self.interval = self.min_interval
+        self._wake.set()
+
+    async def has_pending_orders(self) -> bool:
+        """
+        Tells whether any NEW order is waiting for a payment.
+        """
+        return await self.db_manager.get_one(col_name='orders',
+                                             fltr={'status': OrderStatus.NEW.value},
+                                             projection={'_id': 1}) is not None
+
+    async def run(self, poll: typing.Callable[[], typing.Awaitable[int]],
+                  wait_for_change: typing.Callable[[float], typing.Awaitable[bool]] | None = None) -> None:
+        """
+        Runs the poll coroutine forever.
+
+        Parameters
+        ----------
+        poll : typing.Callable
+            A coroutine function returning the number of new transactions it found.
+        wait_for_change : typing.Callable, optional
+            A coroutine function that returns once there is something new to poll.
+        """
+        while True:
+            self._wake.clear()
+            found = 0
+            failed = False
+            try:
+                with metrics.timer('poll_cycle'):
+                    found = await poll()
+                now = time.monotonic()
+                if self._last_cycle is not None:
+                    metrics.set('poll_lag', now - self._last_cycle)
+                self._last_cycle = now
+                busy = found > 0 or await self.has_pending_orders()
+            except Exception:
+                logging.exception('Error in poll cycle')
+                busy = False
+                failed = True
+
+            if busy:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+            metrics.set('poll_interval', self.interval)
+
+            if wait_for_change is not None and not failed:
+                try:
+                    await wait_for_change(self.max_interval)
+                    continue
+                except Exception:
+                    logging.exception('Error in waiting for changes, falling back to polling')
+                    metrics.inc('wait_for_change_fallbacks')
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+poll_scheduler = PollScheduler(db_manager,
+                               min_interval=config_reader.config.poll_min_interval,
+                               max_interval=config_reader.config.poll_max_interval)
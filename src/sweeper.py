@@ -0,0 +1,146 @@
+import asyncio
+import datetime
+import logging
+import uuid
+
+from src import config_reader
+from src.db_manager import db_manager, DbManager
+from src.exceptions import MongoError, SweepOrdersError
+from src.leader import fenced
+from src.metrics import metrics
+from src.order_cache import order_cache
+from src.order_waiters import order_waiters
+from src.model import OrderRow, OrderStatus
+from src.value_id_allocator import value_id_allocator, ValueIdAllocator
+
+
+class OrderSweeper:
+    """
+    A class used to cancel NEW orders whose expiry time has passed.
+
+    ...
+
+    Expired orders are streamed through the ``(status, expires_at)`` index oldest first and
+    moved to CANCELED in batches with one bulk update each, their value ids are returned
+    to the allocator. Only one batch is held in memory. With leader election on, the
+    sweeper runs on the poller leader and its writes carry the leader's fencing token.
+
+    Attributes
+    ----------
+    db_manager : DbManager
+        a manager to interact with the database
+    allocator : ValueIdAllocator
+        the allocator that receives the freed value ids
+    batch_size : int
+        the number of orders canceled per bulk update
+    fence : int
+        the fencing token of the poller lease, None when leader election is off
+
+    Methods
+    -------
+    sweep():
+        Cancels all expired NEW orders.
+    run(interval):
+        Runs the sweeper forever.
+    """
+    def __init__(self, db_man: DbManager, allocator: ValueIdAllocator, batch_size: int):
+        """
+        Constructs all the necessary attributes for the OrderSweeper object.
+
+        Parameters
+        ----------
+        db_man : DbManager
+            a manager to interact with the database
+        allocator : ValueIdAllocator
+            the allocator that receives the freed value ids
+        batch_size : int
+            the number of orders canceled per bulk update
+        """
+        self.db_manager = db_man
+        self.allocator = allocator
+        self.batch_size = batch_size
+        self.fence: int | None = None
+
+    async def sweep(self) -> int:
+        """
+        Cancels all expired NEW orders.
+
+        Returns
+        -------
+        int
+            The number of canceled orders.
+
+        Raises
+        ------
+        SweepOrdersError
+            If an error occurs while canceling orders.
+        """
+        canceled = 0
+        try:
+            with metrics.timer('sweep_duration'):
+                now = datetime.datetime.now(datetime.timezone.utc)
+                batch = []
+                async for order in self.db_manager.iter_many(col_name='orders',
+                                                             fltr={'status': OrderStatus.NEW.value,
+                                                                   'expires_at': {'$lte': now}},
+                                                             sort=[('expires_at', 1)],
+                                                             projection=OrderRow.projection(),
+                                                             batch_size=self.batch_size):
+                    batch.append(OrderRow.from_db(order))
+                    if len(batch) == self.batch_size:
+                        canceled += await self._cancel(batch)
+                        batch = []
+                if batch:
+                    canceled += await self._cancel(batch)
+        except (MongoError, Exception) as e:
+            logging.exception('Error in sweeping expired orders')
+            raise SweepOrdersError from e
+        finally:
+            metrics.inc('orders_canceled', canceled)
+        if canceled:
+            logging.debug(f'Canceled {canceled} expired orders')
+        return canceled
+
+    async def _cancel(self, orders: list[OrderRow]) -> int:
+        """
+        Cancels a batch of expired orders with one bulk update and frees their value ids.
+        """
+        # canceled_by makes the updates of this batch unique, so bulk_update can tell the applied ones
+        # and an order confirmed in the meantime keeps its value id
+        sweep_id = uuid.uuid4().hex
+        applied = await self.db_manager.bulk_update(
+            col_name='orders',
+            updates=[fenced({'invoice_id': order.invoice_id,
+                             'status': OrderStatus.NEW.value},
+                            {'$set': {'status': OrderStatus.CANCELED.value, 'canceled_by': sweep_id}},
+                            self.fence)
+                     for order in orders],
+            key='invoice_id')
+        canceled = 0
+        for order, ok in zip(orders, applied):
+            if ok:
+                order.status = OrderStatus.CANCELED.value
+                await self.allocator.release(order, fence=self.fence)
+                order_cache.invalidate(order.invoice_id)
+                order_waiters.notify(order.invoice_id, order.status)
+                canceled += 1
+        return canceled
+
+    async def run(self, interval: int) -> None:
+        """
+        Runs the sweeper forever.
+
+        Parameters
+        ----------
+        interval : int
+            Seconds between two sweeps.
+        """
+        while True:
+            try:
+                await self.sweep()
+            except SweepOrdersError:
+                pass
+            await asyncio.sleep(interval)
+
+
+order_sweeper = OrderSweeper(db_manager, value_id_allocator, config_reader.config.sweep_batch_size)
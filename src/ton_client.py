@@ -1,13 +1,21 @@
+import asyncio
 import logging
+import time
 import typing
 from abc import ABC, abstractmethod
 
-from pytoniq import LiteBalancer, BalancerError
+from pytoniq import LiteBalancer, BalancerError, LiteClient, LiteServerError
 from pytoniq_core import Address
+from pytoniq_core.tl import BlockIdExt
 
 from src.db_manager import db_manager, DbManager
-from src.exceptions import CreateClientError, GetTransactionsError, CloseClientError
-from src.model import TransactionRecord
+from src.metrics import metrics
+from src.exceptions import CreateClientError, GetTransactionsError, CloseClientError, WatchAccountError
+from src.model import TransactionRecord, TransactionPage, Checkpoint
+
+
+# the error code of a liteserver query that timed out, e.g. waitMasterchainSeqno without a new block
+LITESERVER_TIMEOUT_CODE = 652
 
 
 class BcClient(ABC):
@@ -24,6 +32,10 @@ class BcClient(ABC):
             Closes the client.
         get_new_transactions(address: typing.Union[Address, str], count: int, from_lt: int = None, from_hash: typing.Optional[bytes] = None, to_lt: int = 0, **kwargs):
             Retrieves new transactions from the blockchain.
+        iter_new_transactions(address: typing.Union[Address, str], to_lt: int = 0, page_size: int = 16, max_pages: int = None):
+            Yields pages of new transactions from the blockchain.
+        wait_accounts_change(addresses: typing.List[str], timeout: float):
+            Waits until a new block holds a transaction of a watched account.
     """
     @abstractmethod
     async def start(self):
@@ -81,6 +93,60 @@ class BcClient(ABC):
         """
         pass
 
+    @abstractmethod
+    def iter_new_transactions(self, address: typing.Union[Address, str], to_lt: int = 0,
+                              page_size: int = 16,
+                              max_pages: int | None = None) -> typing.AsyncIterator[TransactionPage]:
+        """
+            Yields pages of new transactions from the blockchain, newest first.
+
+            Parameters
+            ----------
+            address : typing.Union[Address, str]
+                The address to retrieve transactions from.
+            to_lt : int, optional
+                The logical time of the last known transaction, paging stops there.
+            page_size : int, optional
+                The number of transactions requested per page.
+            max_pages : int, optional
+                The maximum number of pages to fetch.
+
+            Returns
+            -------
+            typing.AsyncIterator[TransactionPage]
+                An iterator over pages of new transactions.
+
+            Raises
+            ------
+            NotImplementedError
+                If the method is not implemented.
+        """
+        pass
+
+    @abstractmethod
+    async def wait_accounts_change(self, addresses: typing.List[str], timeout: float) -> typing.Set[str]:
+        """
+            Waits until a new block holds a transaction of a watched account.
+
+            Parameters
+            ----------
+            addresses : typing.List[str]
+                The watched addresses.
+            timeout : float
+                The number of seconds to wait.
+
+            Returns
+            -------
+            typing.Set[str]
+                The addresses with new transactions, empty on timeout.
+
+            Raises
+            ------
+            NotImplementedError
+                If the method is not implemented.
+        """
+        pass
+
 
 class TonClient(LiteBalancer, BcClient):
     """
@@ -88,36 +154,102 @@ class TonClient(LiteBalancer, BcClient):
 
         ...
 
+        The liteserver connections are opened once and kept warm across poll cycles.
+        The balancer itself pings and reconnects dead peers, a watchdog task restarts
+        the whole pool if every peer is lost or the balancer checker has died.
+
         Attributes
         ----------
         db_manager : DbManager
             a manager to interact with the database
+        health_check_interval : int
+            seconds between two watchdog checks of the pool
+        reuse_count : int
+            number of times the warm pool was reused instead of started
+        restart_count : int
+            number of times the watchdog restarted the pool
+        max_concurrent_requests : int
+            maximum number of transaction pages requested from the pool at once
+        block_wait_ms : int
+            how long a liteserver may hold a request for the next masterchain block
+        min_block_wait_ms : int
+            the shortest wait worth sending, a wait with less time left ends as a timeout
+        max_blocks_behind : int
+            the number of masterchain blocks a wait catches up on before it gives up and
+            reports every watched address
 
         Methods
         -------
         start():
-            Starts the client.
+            Starts the client or reuses the already started pool.
         close():
             Closes the client.
         get_new_transactions(address: typing.Union[Address, str], count: int, from_lt: int = None, from_hash: typing.Optional[bytes] = None, to_lt: int = 0, **kwargs):
             Retrieves new transactions from the blockchain.
+        iter_new_transactions(address: typing.Union[Address, str], to_lt: int = 0, page_size: int = 16, max_pages: int = None):
+            Yields pages of new transactions from the blockchain.
+        wait_accounts_change(addresses: typing.List[str], timeout: float):
+            Follows new masterchain blocks until one holds a transaction of a watched account.
+        get_shard_blocks(seqno: int, shards: typing.Dict[str, int]):
+            Returns the shard blocks a masterchain block adds to the known ones.
     """
     db_manager: DbManager = db_manager
+    health_check_interval: int = 10
+    max_concurrent_requests: int = 4
+    block_wait_ms: int = 8000
+    min_block_wait_ms: int = 1000
+    max_blocks_behind: int = 20
+
+    def __init__(self, peers: typing.List[LiteClient], timeout: int = 10):
+        super().__init__(peers, timeout)
+        self.reuse_count = 0
+        self.restart_count = 0
+        self._start_lock = asyncio.Lock()
+        self._watchdog: asyncio.Task | None = None
+        self._requests = asyncio.Semaphore(self.max_concurrent_requests)
+        self._followed_seqno: int | None = None
+        self._followed_shards: typing.Dict[str, int] = {}
 
     async def start(self):
         """
-        Starts the client.
+        Starts the client. If the pool is already up it is reused.
 
         Raises
         ------
         CreateClientError
             If an error occurs while starting the client.
         """
-        try:
-            await self.start_up()
-        except (BalancerError, Exception) as err:
-            logging.exception('Error in starting up the client')
-            raise CreateClientError from err
+        async with self._start_lock:
+            if self.inited:
+                self.reuse_count += 1
+                return
+            try:
+                await self.start_up()
+            except (BalancerError, Exception) as err:
+                logging.exception('Error in starting up the client')
+                raise CreateClientError from err
+            if self._watchdog is None or self._watchdog.done():
+                self._watchdog = asyncio.create_task(self._watch_pool())
+
+    async def _watch_pool(self):
+        """
+        Restarts the pool when no peer is alive or the balancer checker has stopped.
+        """
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            checker_died = self._checker is not None and self._checker.done()
+            if self.inited and self.alive_peers_num and not checker_died:
+                continue
+            logging.warning(f'Liteserver pool is unhealthy ({self.alive_peers_num}/{self.peers_num} '
+                            f'alive peers), restarting')
+            async with self._start_lock:
+                try:
+                    if self.inited:
+                        await self.close_all()
+                    await self.start_up()
+                    self.restart_count += 1
+                except (BalancerError, Exception):
+                    logging.exception('Error in restarting the client')
 
     async def close(self):
         """
@@ -128,6 +260,11 @@ class TonClient(LiteBalancer, BcClient):
         CloseClientError
             If an error occurs while closing the client.
         """
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        if not self.inited:
+            return
         try:
             await self.close_all()
         except (BalancerError, Exception) as err:
@@ -140,12 +277,16 @@ class TonClient(LiteBalancer, BcClient):
         """
         Retrieves new transactions from the blockchain.
 
+        When ``to_lt`` is given, pages of ``count`` transactions are fetched backward until
+        that logical time is reached, so no transaction is skipped after a long pause.
+        Without ``to_lt`` only the latest ``count`` transactions are returned.
+
         Parameters
         ----------
         address : typing.Union[Address, str]
             The address to retrieve transactions from.
         count : int
-            The number of transactions to retrieve.
+            The number of transactions to retrieve per page.
         from_lt : int, optional
             The logical time to retrieve transactions from.
         from_hash : typing.Optional[bytes], optional
@@ -163,19 +304,252 @@ class TonClient(LiteBalancer, BcClient):
         GetTransactionsError
             If an error occurs while retrieving new transactions.
         """
+        result = []
+        async for page in self.iter_new_transactions(address, to_lt=to_lt, page_size=count,
+                                                     max_pages=None if to_lt else 1,
+                                                     from_lt=from_lt, from_hash=from_hash):
+            result.extend(page.transactions)
+        return result
+
+    async def iter_new_transactions(self, address: typing.Union[Address, str], to_lt: int = 0,
+                                    page_size: int = 16, max_pages: int | None = None,
+                                    from_lt: int = None, from_hash: typing.Optional[bytes] = None
+                                    ) -> typing.AsyncIterator[TransactionPage]:
+        """
+        Yields pages of new transactions from the blockchain, newest first.
+
+        Pages are chained through ``prev_trans_lt``/``prev_trans_hash`` of the last transaction
+        of the previous page. The next page is requested while the current one is being
+        consumed, so decoding and matching overlap with the liteserver round-trip. A page
+        without internal transactions is still yielded, its ``newest`` lets the caller move
+        the checkpoint past outgoing and external transactions.
+
+        Parameters
+        ----------
+        address : typing.Union[Address, str]
+            The address to retrieve transactions from.
+        to_lt : int, optional
+            The logical time of the last known transaction, paging stops there.
+        page_size : int, optional
+            The number of transactions requested per page, at most 16.
+        max_pages : int, optional
+            The maximum number of pages to fetch.
+        from_lt : int, optional
+            The logical time to start paging from, the latest transaction by default.
+        from_hash : typing.Optional[bytes], optional
+            The hash to start paging from.
+
+        Returns
+        -------
+        typing.AsyncIterator[TransactionPage]
+            An iterator over pages of new transactions.
+
+        Raises
+        ------
+        GetTransactionsError
+            If an error occurs while retrieving new transactions.
+        """
+        watched = address if isinstance(address, str) else address.to_str()
+        page_size = min(page_size, 16)
+        pages = 0
+        next_page = asyncio.create_task(self._fetch_page(address, page_size, from_lt, from_hash))
         try:
-            print(f"get_all_transactions")
-            raw_transactions = await self.get_transactions(address, count, from_lt, from_hash,
-                                                           to_lt, **kwargs)
+            while next_page is not None:
+                try:
+                    raw_transactions = await next_page
+                except (BalancerError, Exception) as err:
+                    logging.exception('Error in getting transactions')
+                    raise GetTransactionsError from err
+                next_page = None
+                pages += 1
+
+                fresh = [tr for tr in raw_transactions if tr.lt > to_lt]
+                last = raw_transactions[-1] if raw_transactions else None
+                reached_end = (len(fresh) < len(raw_transactions)
+                               or len(raw_transactions) < page_size
+                               or last.prev_trans_lt == 0
+                               or (max_pages is not None and pages >= max_pages))
+                if not reached_end:
+                    next_page = asyncio.create_task(self._fetch_page(address, page_size,
+                                                                     last.prev_trans_lt,
+                                                                     last.prev_trans_hash))
+                if not fresh:
+                    continue
+                transactions = []
+                for raw_transaction in fresh:
+                    if raw_transaction.in_msg is None or not raw_transaction.in_msg.is_internal:
+                        continue
+                    try:
+                        transactions.append(TransactionRecord.from_transaction(raw_transaction, watched))
+                    except Exception:
+                        logging.exception(f'Error in decoding transaction {raw_transaction.lt} of {watched}, skipped')
+                        metrics.inc('transactions_undecodable')
+                newest = max(fresh, key=lambda raw_transaction: raw_transaction.lt)
+                yield TransactionPage(transactions, Checkpoint(address=watched, lt=newest.lt,
+                                                               hash=newest.cell.hash.hex()))
+        finally:
+            if next_page is not None and not next_page.done():
+                next_page.cancel()
+
+    async def wait_accounts_change(self, addresses: typing.List[str], timeout: float) -> typing.Set[str]:
+        """
+        Follows new masterchain blocks until one holds a transaction of a watched account.
 
-            print(f"RAW TRANSACTIONS: {raw_transactions}")
-            result = [TransactionRecord.from_transaction(raw_transaction)
-                      for raw_transaction in raw_transactions]
+        Every new masterchain block is resolved to its shard blocks and their short
+        transaction lists (account, lt, hash) are filtered against the watched accounts, the
+        way ``BlockScanner`` does. The cost per block does not grow with the number of
+        addresses. Blocks are followed on from the last one seen by the previous call, so
+        nothing is missed between two calls. The first call, a call after an error, or a
+        call more than ``max_blocks_behind`` blocks behind only takes the latest block as
+        its position and reports every address, the caller then checks them all once.
+
+        Parameters
+        ----------
+        addresses : typing.List[str]
+            The watched addresses.
+        timeout : float
+            The number of seconds to wait.
+
+        Returns
+        -------
+        typing.Set[str]
+            The addresses with new transactions, empty on timeout.
+
+        Raises
+        ------
+        WatchAccountError
+            If an error occurs while following blocks.
+        """
+        deadline = time.monotonic() + timeout
+        watched = {}
+        for address in addresses:
+            parsed = Address(address)
+            watched[(parsed.wc, parsed.hash_part)] = address
+        try:
+            if self._followed_seqno is None:
+                return self._restart_following((await self.get_masterchain_info())['last']['seqno'], addresses)
+            while True:
+                remaining_ms = int((deadline - time.monotonic()) * 1000)
+                if remaining_ms < self.min_block_wait_ms:
+                    return set()
+                try:
+                    info = await self.wait_masterchain_seqno(self._followed_seqno + 1,
+                                                             min(remaining_ms, self.block_wait_ms),
+                                                             'getMasterchainInfo')
+                except asyncio.TimeoutError:
+                    continue
+                except LiteServerError as err:
+                    # the liteserver answers a wait that saw no new block with a timeout error
+                    if err.code != LITESERVER_TIMEOUT_CODE:
+                        raise
+                    continue
+                last_seqno = info['last']['seqno']
+                if last_seqno - self._followed_seqno > self.max_blocks_behind:
+                    return self._restart_following(last_seqno, addresses)
+                changed = set()
+                for seqno in range(self._followed_seqno + 1, last_seqno + 1):
+                    for block in await self.get_shard_blocks(seqno, self._followed_shards):
+                        for transaction_id in await self.raw_get_block_transactions(block):
+                            account: Address = transaction_id['account']
+                            address = watched.get((account.wc, account.hash_part))
+                            if address is not None:
+                                changed.add(address)
+                    self._followed_seqno = seqno
+                    if changed:
+                        return changed
         except (BalancerError, Exception) as err:
-            logging.exception('Error in getting transactions')
-            raise GetTransactionsError from err
-        else:
-            return result
+            self._followed_seqno = None
+            logging.exception('Error in following masterchain blocks')
+            raise WatchAccountError from err
+
+    def _restart_following(self, seqno: int, addresses: typing.List[str]) -> typing.Set[str]:
+        """
+        Follows blocks from the given masterchain block on and reports every address as changed.
+        """
+        self._followed_seqno = seqno
+        self._followed_shards = {}
+        return set(addresses)
+
+    async def get_shard_blocks(self, seqno: int, shards: typing.Dict[str, int]) -> typing.List[BlockIdExt]:
+        """
+        Returns the shard blocks a masterchain block adds to the known ones.
+
+        Shard blocks created between two masterchain blocks are looked up by seqno. A shard
+        seen for the first time after a split or merge is walked back through the previous
+        block references until the last known blocks of its parent shards. Without known
+        shards only the blocks the masterchain block references are returned.
+
+        Parameters
+        ----------
+        seqno : int
+            The seqno of the masterchain block.
+        shards : typing.Dict[str, int]
+            The last known seqno per shard ("workchain:shard"), replaced in place by the
+            shards of the masterchain block.
+
+        Returns
+        -------
+        typing.List[BlockIdExt]
+            The new shard blocks, parents before their children.
+        """
+        mc_block, _ = await self.lookup_block(wc=-1, shard=-2 ** 63, seqno=seqno)
+        tops = await self.get_all_shards_info(mc_block)
+        blocks = []
+        seen = set()
+        for top in tops:
+            key = f'{top.workchain}:{top.shard}'
+            if key in shards:
+                for shard_seqno in range(shards[key] + 1, top.seqno + 1):
+                    if shard_seqno == top.seqno:
+                        block = top
+                    else:
+                        block, _ = await self.lookup_block(wc=top.workchain, shard=top.shard, seqno=shard_seqno)
+                    blocks.append(block)
+            elif shards:
+                blocks.extend(await self._walk_back(top, shards, seen))
+            else:
+                blocks.append(top)
+        shards.clear()
+        shards.update({f'{top.workchain}:{top.shard}': top.seqno for top in tops})
+        return blocks
+
+    async def _walk_back(self, top: BlockIdExt, shards: typing.Dict[str, int],
+                         seen: typing.Set[typing.Tuple[str, int]]) -> typing.List[BlockIdExt]:
+        """
+        Returns the blocks from the last known blocks of the parent shards up to a new shard block.
+        """
+        blocks = []
+        pending = [top]
+        while pending:
+            block = pending.pop()
+            key = f'{block.workchain}:{block.shard}'
+            if block.seqno <= shards.get(key, -1) or (key, block.seqno) in seen:
+                continue
+            seen.add((key, block.seqno))
+            blocks.append(block)
+            info = (await self.raw_get_block_header(block)).info
+            shard = block.shard % 2 ** 64
+            low_bit = shard & -shard
+            if info.after_merge:
+                refs = [(shard - low_bit // 2, info.prev_ref.prev1), (shard + low_bit // 2, info.prev_ref.prev2)]
+            elif info.after_split:
+                refs = [((shard - low_bit) | (low_bit << 1), info.prev_ref.prev)]
+            else:
+                refs = [(shard, info.prev_ref.prev)]
+            for prev_shard, ref in refs:
+                pending.append(BlockIdExt(workchain=block.workchain,
+                                          shard=prev_shard - 2 ** 64 if prev_shard >= 2 ** 63 else prev_shard,
+                                          seqno=ref.seqno, root_hash=ref.root_hash, file_hash=ref.file_hash))
+        return blocks[::-1]
+
+    async def _fetch_page(self, address: typing.Union[Address, str], count: int,
+                          from_lt: int = None, from_hash: typing.Optional[bytes] = None) -> list:
+        """
+        Requests one page of raw transactions, bounded by ``max_concurrent_requests``.
+        """
+        async with self._requests:
+            raw_transactions, _ = await self.raw_get_transactions(address, count, from_lt, from_hash)
+            return raw_transactions
 
 
 try:
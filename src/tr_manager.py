@@ -1,10 +1,18 @@
+import asyncio
 import logging
 
 from src import config_reader
 from src.db_manager import db_manager
-from src.model import TransactionRecord, OrderStatus, Order
+from src.leader import fenced
+from src.matcher import order_matcher
+from src.metrics import metrics
+from src.order_cache import order_cache
+from src.order_waiters import order_waiters
+from src.model import TransactionRecord, OrderStatus, OrderRow, Checkpoint
+from src.value_id_allocator import value_id_allocator
 from src.exceptions import StoreNewTransactionsError, TonClientError, \
-    TransactionManagerError, MongoError, CheckTransactionsError, GetOldLatestTransactionError
+    TransactionManagerError, MongoError, CheckTransactionsError, GetOldLatestTransactionError, \
+    UpdateLatestTransactionError, DuplicateError
 from ton_client import client, BcClient
 from pydantic import ValidationError
 
@@ -15,25 +23,66 @@ class TransactionManager:
 
     ...
 
+    Every watched address has its own checkpoint. The addresses are polled concurrently,
+    at most ``max_concurrent_addresses`` at a time, and all of them share the client's
+    connection pool. Transaction pages are requested one at a time per address through the
+    client's FIFO request semaphore, so a busy address paging through a long backlog
+    takes turns with the others and cannot starve them.
+
+    Checking an address runs as a pipeline of three stages connected by queues of
+    ``pipeline_depth`` pages: fetching pages from the chain, matching them against the
+    NEW orders, and writing confirmations and transactions to the database. The stages
+    overlap, a full queue holds back the stage feeding it. The checkpoint only moves once
+    every page is written.
+
+    A failed cycle fetches its pages again, so a transaction that already paid an order
+    is never matched again, and the value ids of the orders confirmed by a cycle are only
+    released once the checkpoint moved past their payments. When the cycle fails they are
+    held in quarantine for ``replay_hold`` seconds instead.
+
     Attributes
     ----------
     client : BcClient
         a client to interact with the blockchain
     db_manager : DbManager
         a manager to interact with the database
-    latest_transaction : TransactionRecord
-        the latest transaction record
+    addresses : list
+        the watched addresses
+    legacy_address : str
+        the address the transactions stored without an address were received on
+    latest_transactions : dict
+        the checkpoint of the latest stored transaction per address
+    fence : int
+        the fencing token of the poller lease, None when leader election is off
 
     Methods
     -------
     check_transactions_in_bc():
         Checks for new transactions in the blockchain.
-    get_old_latest_transaction():
-        Retrieves the latest transaction from the database.
-    store_new_transactions(new_transactions):
-        Stores new transactions in the database.
+    check_address(address):
+        Checks for new transactions of one address.
+    confirm_orders(new_transactions):
+        Confirms the NEW orders paid by the given transactions.
+    match_orders(new_transactions, exclude=None):
+        Finds the NEW orders paid by the given transactions.
+    apply_matches(matches, release=True):
+        Moves matched orders to CONFIRMED and releases their value ids.
+    wait_for_new_transactions(timeout):
+        Waits until a watched address has a new transaction.
+    ingest(new_transactions, address):
+        Confirms orders and stores transactions found outside of polling.
+    get_old_latest_transaction(address):
+        Retrieves the checkpoint of the latest stored transaction.
+    store_new_transactions(new_transactions, address, advance_checkpoint=True):
+        Stores new transactions and advances the checkpoint.
+    advance_checkpoint(address, newest):
+        Moves the checkpoint of the address to the given transaction.
     """
-    def __init__(self, cl, db_man):
+    pipeline_depth = 4
+    replay_hold = 300.0
+
+    def __init__(self, cl, db_man, addresses: list[str], max_concurrent_addresses: int = 16,
+                 legacy_address: str | None = None):
         """
        Constructs all the necessary attributes for the TransactionManager object.
 
@@ -43,65 +92,353 @@ class TransactionManager:
            a client to interact with the blockchain
        db_man : DbManager
            a manager to interact with the database
+       addresses : list
+           the watched addresses
+       max_concurrent_addresses : int, optional
+           the number of addresses polled at the same time
+       legacy_address : str, optional
+           the address the transactions stored without an address were received on
        """
         self.client: BcClient = cl
         self.db_manager = db_man
+        self.addresses = addresses
+        self.legacy_address = legacy_address
+        self.latest_transactions: dict[str, Checkpoint] = {}
+        self._changed: set[str] | None = None
+        self._failed: set[str] = set()
+        self._address_slots = asyncio.Semaphore(max_concurrent_addresses)
+        self.fence: int | None = None
 
-    latest_transaction: TransactionRecord | None = None
-
-    async def check_transactions_in_bc(self) -> None:
+    async def check_transactions_in_bc(self) -> int:
         """
         Checks for new transactions in the blockchain.
 
+        Only the addresses reported by ``wait_for_new_transactions`` are checked when it was
+        used, every watched address otherwise. An address that fails is logged, counted in
+        the ``addresses_failed`` metric and checked again next cycle, the cycle only fails
+        when every address failed.
+
+        Returns
+        -------
+        int
+            The number of new transactions found.
+
         Raises
         ------
         CheckTransactionsError
-            If an error occurs while checking for new transactions.
+            If an error occurs while checking for new transactions of every address.
         """
         try:
             print('check_transactions_in_bc')
-            await client.start()
-            if last_transaction := await self.get_old_latest_transaction():
-                new_transactions = await client.get_new_transactions(
-                                         address=config_reader.config.pay_address.get_secret_value(),
-                                         count=16,
-                                         to_lt=last_transaction.lt)
-            else:
-                new_transactions = await client.get_new_transactions(
-                                         address=config_reader.config.pay_address.get_secret_value(),
-                                         count=16)
-            await client.close()
-            print(f'new transactions: {new_transactions}')
-            orders = await self.db_manager.get_many(col_name='orders',
-                                                    fltr={'status': OrderStatus.NEW.value})
-            if orders:
-                orders = [Order.deserialize(order) for order in orders]
-                confirmed_orders = [order for order in orders
-                                    if order.value_id in [transaction.value for transaction in new_transactions]]
-                print(f'confirmed: {confirmed_orders}')
-                for conf_order in confirmed_orders:
-                    conf_order.status = OrderStatus.CONFIRMED.value
-                    await self.db_manager.replace_one(col_name='orders',
-                                                      fltr={'invoice_id': conf_order.invoice_id,
-                                                            'status': OrderStatus.NEW.value,
-                                                            'value_id': conf_order.value_id},
-                                                      replacement=conf_order.serialize())
-            await self.store_new_transactions(new_transactions)
+            await self.client.start()
+            addresses = self.addresses if self._changed is None else sorted(self._changed)
+            self._changed = None
+            results = await asyncio.gather(*(self._check_address_bounded(address) for address in addresses),
+                                           return_exceptions=True)
         except (MongoError,
                 TonClientError,
                 TransactionManagerError,
                 Exception) as e:
             logging.exception('Error in on_get_transactions')
             raise CheckTransactionsError from e
+        failed = [address for address, result in zip(addresses, results) if isinstance(result, BaseException)]
+        metrics.set('addresses_failed', len(failed))
+        if failed:
+            logging.error(f'Failed to check {len(failed)} of {len(addresses)} addresses: {", ".join(failed)}')
+            if len(failed) == len(addresses):
+                raise CheckTransactionsError(f'Failed to check all {len(addresses)} addresses')
+        self._failed = set(failed)
+        return sum(result for result in results if not isinstance(result, BaseException))
+
+    async def _check_address_bounded(self, address: str) -> int:
+        """
+        Checks one address once a polling slot is free.
+        """
+        async with self._address_slots:
+            return await self.check_address(address)
 
-    async def get_old_latest_transaction(self) -> TransactionRecord | None:
+    async def check_address(self, address: str) -> int:
         """
-        Retrieves the latest transaction from the database.
+        Checks for new transactions of one address.
+
+        Parameters
+        ----------
+        address : str
+            The watched address.
 
         Returns
         -------
-        TransactionRecord
-            The latest transaction record.
+        int
+            The number of new transactions found.
+
+        Raises
+        ------
+        CheckTransactionsError
+            If an error occurs while checking for new transactions.
+        """
+        try:
+            last_transaction = await self.get_old_latest_transaction(address)
+            fetched = asyncio.Queue(maxsize=self.pipeline_depth)
+            matched = asyncio.Queue(maxsize=self.pipeline_depth)
+            async with asyncio.TaskGroup() as stages:
+                stages.create_task(self._fetch_stage(address, last_transaction, fetched))
+                stages.create_task(self._match_stage(fetched, matched))
+                writer = stages.create_task(self._write_stage(address, matched))
+            return writer.result()
+        except (MongoError,
+                TonClientError,
+                TransactionManagerError,
+                Exception) as e:
+            logging.exception(f'Error in checking transactions of {address}')
+            raise CheckTransactionsError from e
+
+    async def _fetch_stage(self, address: str, last_transaction: Checkpoint | None,
+                           fetched: asyncio.Queue) -> None:
+        """
+        Feeds the pages of new transactions of an address into the pipeline.
+        """
+        async for page in self.client.iter_new_transactions(
+                address=address,
+                to_lt=last_transaction.lt if last_transaction else 0,
+                max_pages=None if last_transaction else 1):
+            print(f'new transactions: {page.transactions}')
+            await fetched.put(page)
+        await fetched.put(None)
+
+    async def _match_stage(self, fetched: asyncio.Queue, matched: asyncio.Queue) -> None:
+        """
+        Matches every fetched page against the NEW orders.
+
+        Orders matched by an earlier page may not be confirmed yet when the next page is
+        matched, they are skipped so that no order is paid twice.
+        """
+        claimed: set[int] = set()
+        while (page := await fetched.get()) is not None:
+            matches = await self.match_orders(page.transactions, exclude=claimed)
+            claimed.update(order.invoice_id for order, _ in matches)
+            await matched.put((page, matches))
+        await matched.put(None)
+
+    async def _write_stage(self, address: str, matched: asyncio.Queue) -> int:
+        """
+        Confirms the matched orders, stores the transactions and finally advances the checkpoint.
+
+        The checkpoint moves to the newest raw transaction fetched, so transactions that
+        are not payments are not fetched again on the next cycle. The value ids of the
+        confirmed orders are released after it moved.
+        """
+        newest = None
+        found = 0
+        confirmed = []
+        try:
+            while (item := await matched.get()) is not None:
+                page, matches = item
+                confirmed.extend(await self.apply_matches(matches, release=False))
+                await self.store_new_transactions(page.transactions, address, advance_checkpoint=False)
+                found += len(page.transactions)
+                if newest is None or page.newest.lt > newest.lt:
+                    newest = page.newest
+            if newest is not None:
+                await self.advance_checkpoint(address, newest)
+        except BaseException:
+            await self._release(confirmed, hold=self.replay_hold)
+            raise
+        await self._release(confirmed)
+        return found
+
+    async def wait_for_new_transactions(self, timeout: float) -> bool:
+        """
+        Waits until a watched address has a new transaction.
+
+        The changed addresses are remembered, the next ``check_transactions_in_bc`` only
+        checks them and the addresses that failed in the previous cycle.
+
+        Parameters
+        ----------
+        timeout : float
+            The number of seconds to wait.
+
+        Returns
+        -------
+        bool
+            True if an account changed, False on timeout.
+
+        Raises
+        ------
+        WatchAccountError
+            If an error occurs while following blocks.
+        """
+        await self.client.start()
+        changed = await self.client.wait_accounts_change(self.addresses, timeout)
+        if not changed:
+            return False
+        self._changed = changed | self._failed | (self._changed or set())
+        return True
+
+    async def ingest(self, new_transactions: list[TransactionRecord], address: str) -> int:
+        """
+        Confirms orders and stores transactions found outside of polling, e.g. by a block scan.
+
+        Parameters
+        ----------
+        new_transactions : list
+            The new transactions of the address.
+        address : str
+            The watched address.
+
+        Returns
+        -------
+        int
+            The number of newly stored transactions.
+        """
+        confirmed = await self.apply_matches(await self.match_orders(new_transactions), release=False)
+        try:
+            inserted, _ = await self.store_new_transactions(new_transactions, address)
+        except BaseException:
+            await self._release(confirmed, hold=self.replay_hold)
+            raise
+        await self._release(confirmed)
+        return inserted
+
+    async def confirm_orders(self, new_transactions: list[TransactionRecord]) -> list[OrderRow]:
+        """
+        Confirms the NEW orders paid by the given transactions.
+
+        Parameters
+        ----------
+        new_transactions : list
+            A page of new transactions.
+
+        Returns
+        -------
+        list
+            The orders that were confirmed.
+        """
+        return await self.apply_matches(await self.match_orders(new_transactions))
+
+    async def match_orders(self, new_transactions: list[TransactionRecord],
+                           exclude: set[int] | None = None) -> list[tuple[OrderRow, TransactionRecord]]:
+        """
+        Finds the NEW orders paid by the given transactions.
+
+        Orders named by a transaction comment are read through the invoice_id index,
+        the others through their value_id. Transactions that already paid an order are
+        left out, so a page fetched again after a failed cycle pays nothing twice.
+
+        Parameters
+        ----------
+        new_transactions : list
+            A page of new transactions.
+        exclude : set, optional
+            Invoice ids of orders that are already matched.
+
+        Returns
+        -------
+        list
+            A list of (order, transaction) pairs.
+        """
+        hashes = [transaction.hash for transaction in new_transactions if transaction.hash]
+        if hashes:
+            paid = {order['paid_by']
+                    async for order in self.db_manager.iter_many(col_name='orders',
+                                                                 fltr={'paid_by': {'$in': hashes}},
+                                                                 projection={'_id': 0, 'paid_by': 1})}
+            new_transactions = [transaction for transaction in new_transactions if transaction.hash not in paid]
+        values = list({transaction.value for transaction in new_transactions})
+        if not values:
+            return []
+        invoice_ids = list({order_matcher.invoice_id_from_comment(transaction.comment)
+                            for transaction in new_transactions} - {None})
+        fltr = {'status': OrderStatus.NEW.value, 'value_id': {'$in': values}}
+        if invoice_ids:
+            fltr = {'status': OrderStatus.NEW.value,
+                    '$or': [{'invoice_id': {'$in': invoice_ids}}, {'value_id': {'$in': values}}]}
+        orders = [OrderRow.from_db(order)
+                  async for order in self.db_manager.iter_many(col_name='orders', fltr=fltr,
+                                                               sort=[('_id', 1)], projection=OrderRow.projection())
+                  if not exclude or order['invoice_id'] not in exclude]
+        if not orders:
+            return []
+        matches = order_matcher.match(orders, new_transactions)
+        print(f'confirmed: {[order for order, _ in matches]}')
+        return matches
+
+    async def apply_matches(self, matches: list[tuple[OrderRow, TransactionRecord]],
+                            release: bool = True) -> list[OrderRow]:
+        """
+        Moves matched orders to CONFIRMED and releases their value ids.
+
+        Parameters
+        ----------
+        matches : list
+            A list of (order, transaction) pairs.
+        release : bool, optional
+            Whether to release the value ids now, otherwise the caller releases them.
+
+        Returns
+        -------
+        list
+            The orders that were confirmed.
+        """
+        if not matches:
+            return []
+        # paid_by makes every confirmation unique, so bulk_update can tell the applied ones
+        applied = await self.db_manager.bulk_update(
+            col_name='orders',
+            updates=[self._fenced({'invoice_id': order.invoice_id,
+                                   'status': OrderStatus.NEW.value,
+                                   'value_id': order.value_id},
+                                  {'$set': {'status': OrderStatus.CONFIRMED.value,
+                                            'paid_by': transaction.hash}})
+                     for order, transaction in matches],
+            key='invoice_id')
+        confirmed_orders = []
+        for (order, transaction), confirmed in zip(matches, applied):
+            if confirmed:
+                order.status = OrderStatus.CONFIRMED.value
+                if release:
+                    await value_id_allocator.release(order, fence=self.fence)
+                order_cache.invalidate(order.invoice_id)
+                order_waiters.notify(order.invoice_id, order.status)
+                confirmed_orders.append(order)
+            else:
+                logging.error(f'Failed to confirm order {order.invoice_id} paid by transaction {transaction.lt}')
+        return confirmed_orders
+
+    async def _release(self, orders: list[OrderRow], hold: float | None = None) -> None:
+        """
+        Releases the value ids of confirmed orders, into quarantine for ``hold`` seconds if given.
+        """
+        for order in orders:
+            try:
+                await value_id_allocator.release(order, fence=self.fence, hold=hold)
+            except (MongoError, Exception):
+                logging.exception(f'Error in releasing the value id of order {order.invoice_id}')
+
+    def _fenced(self, fltr: dict, update: dict) -> tuple[dict, dict]:
+        """
+        Adds the fencing token to a write, so it is rejected once a newer leader wrote the document.
+        """
+        return fenced(fltr, update, self.fence)
+
+    async def get_old_latest_transaction(self, address: str) -> Checkpoint | None:
+        """
+        Retrieves the checkpoint of the latest stored transaction.
+
+        The persisted checkpoint is read first. If there is none yet, the newest
+        stored transaction is looked up through the lt index. Transactions stored
+        before they carried an address only count for ``legacy_address``, any other
+        new address starts from its newest page.
+
+        Parameters
+        ----------
+        address : str
+            The watched address.
+
+        Returns
+        -------
+        Checkpoint
+            The checkpoint of the latest stored transaction.
 
         Raises
         ------
@@ -109,26 +446,50 @@ class TransactionManager:
             If an error occurs while retrieving the latest transaction.
         """
         try:
-            transactions_in_db = await self.db_manager.get_many(col_name='transactions', fltr={})
-            if not transactions_in_db:
+            checkpoint = await self.db_manager.get_one(col_name='checkpoints',
+                                                       fltr={'address': address},
+                                                       projection=Checkpoint.projection())
+            if checkpoint:
+                self.latest_transactions[address] = Checkpoint.deserialize(checkpoint)
+                return self.latest_transactions[address]
+
+            fltr = {'address': {'$in': [address, None]}} if address == self.legacy_address else {'address': address}
+            latest_in_db = await self.db_manager.get_one(col_name='transactions',
+                                                         fltr=fltr,
+                                                         sort=[('lt', -1)],
+                                                         projection={'_id': 0, 'lt': 1, 'hash': 1})
+            if not latest_in_db:
                 return None
-            transactions = [TransactionRecord.deserialize(transactions_in_db) for transactions_in_db in transactions_in_db]
-            sorted_transactions_in_db = sorted(transactions, key=lambda tr: tr.timestamp, reverse=True)
-            self.latest_transaction = sorted_transactions_in_db[0]
-            return self.latest_transaction
+            self.latest_transactions[address] = Checkpoint(address=address,
+                                                           lt=latest_in_db['lt'],
+                                                           hash=latest_in_db.get('hash', ''))
+            return self.latest_transactions[address]
         except (MongoError,
                 ValidationError,
                 Exception) as e:
             raise GetOldLatestTransactionError from e
 
-    async def store_new_transactions(self, new_transactions: list[TransactionRecord]):
+    async def store_new_transactions(self, new_transactions: list[TransactionRecord],
+                                     address: str, advance_checkpoint: bool = True) -> tuple[int, int]:
         """
-        Stores new transactions in the database.
+        Stores new transactions in the database and advances the checkpoint of the address.
+
+        Transactions are upserted by (address, lt, hash), so storing the same transaction
+        twice after a retry or an overlapping poll is a no-op.
 
         Parameters
         ----------
         new_transactions : list
             A list of new transactions to be stored.
+        address : str
+            The watched address the transactions were fetched for.
+        advance_checkpoint : bool, optional
+            Whether to move the checkpoint to the newest of the transactions.
+
+        Returns
+        -------
+        tuple
+            The number of newly stored transactions and the number of duplicates.
 
         Raises
         ------
@@ -138,15 +499,54 @@ class TransactionManager:
         try:
             if len(new_transactions) == 0:
                 logging.debug('No new transactions to store')
-                return
+                return 0, 0
+
+            inserted, duplicates = await self.db_manager.upsert_many(
+                col_name='transactions',
+                documents=[({'address': tr.address, 'lt': tr.lt, 'hash': tr.hash}, tr.serialize())
+                           for tr in new_transactions])
+            metrics.inc('transactions_stored', inserted)
+            metrics.inc('transactions_duplicate', duplicates)
+            logging.debug(f'Stored {inserted} new transactions, skipped {duplicates} duplicates')
 
-            await self.db_manager.add_many(col_name='transactions',
-                                           data=[tr.serialize() for tr in new_transactions])
-            logging.debug(f'Stored new transactions: {new_transactions}')
+            if advance_checkpoint:
+                await self.advance_checkpoint(address, max(new_transactions, key=lambda tr: tr.lt))
+            return inserted, duplicates
         except (MongoError,
                 Exception) as e:
             logging.exception('Error in storing new transactions')
             raise StoreNewTransactionsError from e
 
+    async def advance_checkpoint(self, address: str, newest: TransactionRecord | Checkpoint) -> None:
+        """
+        Moves the checkpoint of the address to the given transaction.
+
+        Parameters
+        ----------
+        address : str
+            The watched address.
+        newest : TransactionRecord | Checkpoint
+            The newest stored or skipped transaction of the address.
+
+        Raises
+        ------
+        UpdateLatestTransactionError
+            If an error occurs while saving the checkpoint, or a newer leader wrote it.
+        """
+        try:
+            checkpoint = Checkpoint(address=address, lt=newest.lt, hash=newest.hash)
+            fltr, update = self._fenced({'address': address}, {'$set': checkpoint.serialize()})
+            await self.db_manager.update_one(col_name='checkpoints', fltr=fltr, update=update)
+            self.latest_transactions[address] = checkpoint
+        except DuplicateError as e:
+            raise UpdateLatestTransactionError(f'The checkpoint of {address} was written by a newer leader') from e
+        except (MongoError,
+                Exception) as e:
+            logging.exception('Error in saving the checkpoint')
+            raise UpdateLatestTransactionError from e
+
 
-tr_manager = TransactionManager(client, db_manager)
+tr_manager = TransactionManager(client, db_manager,
+                                addresses=config_reader.config.watched_addresses(),
+                                max_concurrent_addresses=config_reader.config.max_concurrent_addresses,
+                                legacy_address=config_reader.config.pay_address.get_secret_value())
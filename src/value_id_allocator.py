@@ -0,0 +1,345 @@
+import logging
+import time
+
+from src import config_reader
+from src.db_manager import db_manager, DbManager
+from src.exceptions import DuplicateError, AllocateValueIdError, MongoError
+from src.leader import fenced
+from src.model import Order, OrderRow, OrderStatus
+
+
+class ValueIdAllocator:
+    """
+    A class used to allocate unique value ids to new orders.
+
+    ...
+
+    Every order value has a document in the ``value_ids`` collection holding a counter
+    and a sorted list of freed offsets. Allocation pops the smallest freed offset, or
+    increments the counter when none is free, with a single atomic ``find_one_and_update``,
+    so concurrent requests never receive the same value id and customers are asked for the
+    smallest possible offset. A partial unique index on ``value_id`` among NEW orders guards
+    the invariant in the database. The index cannot be built while old duplicates remain,
+    so before a process first increments the counter of a value, it moves the counter
+    past the highest value id held by a NEW order of that value.
+
+    The offset of a canceled order is held in a ``quarantine`` list for ``grace`` seconds
+    before it joins the free list. The customer may still pay the expired invoice, and
+    that late payment must not confirm a new order that reused the value id. Matured
+    offsets are moved to the free list when a value has no free offset left.
+
+    A value id can collide with an order of another value, e.g. value 100 with offset 4
+    and value 104 with offset 0. The colliding offset is held in quarantine for
+    ``collision_hold`` seconds, until the other order has likely left the NEW status,
+    instead of being lost.
+
+    The free lists are mirrored in memory, so a value without freed slots goes straight
+    to the counter without an extra round-trip. An empty list is only trusted for
+    ``free_cache_ttl`` seconds, so slots freed by another process, e.g. the poller or the
+    sweeper, are reused shortly after. A stale cache can only lead to a higher offset than
+    necessary, never to a duplicate value id.
+
+    Attributes
+    ----------
+    db_manager : DbManager
+        a manager to interact with the database
+    grace : float
+        seconds the value id of a canceled order is held back before it is reused
+    max_attempts : int
+        how many value ids are tried before giving up on an order
+    collision_hold : float
+        seconds an offset whose value id collided with another value is held back
+    free_cache_ttl : float
+        seconds an empty free list is trusted before the database is asked again
+
+    Methods
+    -------
+    allocate(value):
+        Allocates the smallest free value id for the given value.
+    allocate_many(value, count):
+        Allocates several value ids for the given value.
+    release(order, fence=None, hold=None):
+        Returns the value id of an order that left the NEW status to the free list.
+    add_order(order):
+        Allocates a value id for the order and stores it.
+    add_orders(orders):
+        Allocates value ids for many orders and stores them with one bulk insert.
+    """
+    col_name = 'value_ids'
+    max_attempts = 5
+    collision_hold = 60.0
+    free_cache_ttl = 1.0
+
+    def __init__(self, db_man: DbManager, grace: float = 0):
+        """
+        Constructs all the necessary attributes for the ValueIdAllocator object.
+
+        Parameters
+        ----------
+        db_man : DbManager
+            a manager to interact with the database
+        grace : float, optional
+            seconds the value id of a canceled order is held back before it is reused
+        """
+        self.db_manager = db_man
+        self.grace = grace
+        self._free: dict[int, tuple[float, list[int]]] = {}
+        self._seeded: set[int] = set()
+
+    async def allocate(self, value: int) -> int:
+        """
+        Allocates the smallest free value id for the given value.
+
+        Parameters
+        ----------
+        value : int
+            The value of the order.
+
+        Returns
+        -------
+        int
+            The allocated value id, the first one equals the value itself.
+        """
+        return (await self.allocate_many(value, 1))[0]
+
+    async def allocate_many(self, value: int, count: int) -> list[int]:
+        """
+        Allocates several value ids for the given value.
+
+        Freed offsets are taken first, one atomic pop each, the rest comes from a single
+        increment of the counter. Once the free list is empty, the matured offsets in
+        quarantine are moved to it once.
+
+        Parameters
+        ----------
+        value : int
+            The value of the orders.
+        count : int
+            The number of value ids.
+
+        Returns
+        -------
+        list
+            The allocated value ids.
+        """
+        value_ids = []
+        promoted = False
+        while len(value_ids) < count and self._may_have_free(value):
+            before = await self.db_manager.find_one_and_update(col_name=self.col_name,
+                                                               fltr={'_id': value, 'free.0': {'$exists': True}},
+                                                               update={'$pop': {'free': -1}},
+                                                               return_new=False)
+            if not before:
+                if not promoted:
+                    promoted = True
+                    if await self._promote(value):
+                        continue
+                self._cache(value, [])
+                break
+            self._cache(value, before['free'][1:])
+            value_ids.append(value + before['free'][0])
+
+        remaining = count - len(value_ids)
+        if remaining and value not in self._seeded:
+            await self._resync(value)
+            self._seeded.add(value)
+        if remaining:
+            counter = await self.db_manager.find_one_and_update(col_name=self.col_name,
+                                                                fltr={'_id': value},
+                                                                update={'$inc': {'seq': remaining}},
+                                                                upsert=True)
+            first = value + counter['seq'] - remaining
+            value_ids.extend(range(first, first + remaining))
+        return value_ids
+
+    async def release(self, order: Order | OrderRow, fence: int | None = None, hold: float | None = None) -> None:
+        """
+        Returns the value id of an order that left the NEW status to the free list.
+
+        The value id of a canceled order goes to the quarantine first, so does any value
+        id released with a ``hold``.
+
+        Parameters
+        ----------
+        order : Order or OrderRow
+            The order that left the NEW status.
+        fence : int, optional
+            The fencing token of the poller lease, the release is dropped once a newer
+            leader released a value id of the same value.
+        hold : float, optional
+            Seconds the value id is held in quarantine before it is reused.
+        """
+        offset = order.value_id - order.value
+        if offset < 0:
+            return
+        if hold is None and order.status == OrderStatus.CANCELED.value:
+            hold = self.grace
+        if hold:
+            fltr, update = fenced({'_id': order.value, 'free': {'$ne': offset}, 'quarantine.offset': {'$ne': offset}},
+                                  {'$push': {'quarantine': {'offset': offset, 'until': time.time() + hold}}},
+                                  fence)
+            await self.db_manager.find_one_and_update(col_name=self.col_name, fltr=fltr, update=update)
+            return
+        fltr, update = fenced({'_id': order.value, 'free': {'$ne': offset}},
+                              {'$push': {'free': {'$each': [offset], '$sort': 1}}},
+                              fence)
+        after = await self.db_manager.find_one_and_update(col_name=self.col_name, fltr=fltr, update=update)
+        if after:
+            self._cache(order.value, after['free'])
+
+    def _cache(self, value: int, free: list[int]) -> None:
+        """
+        Replaces the cached free list of a value with the persisted one.
+        """
+        self._free[value] = (time.monotonic(), free)
+
+    async def _promote(self, value: int) -> bool:
+        """
+        Moves the offsets whose quarantine is over to the free list, tells whether there were any.
+        """
+        document = await self.db_manager.get_one(col_name=self.col_name,
+                                                 fltr={'_id': value},
+                                                 projection={'_id': 0, 'quarantine': 1})
+        now = time.time()
+        matured = sorted(entry['offset'] for entry in (document or {}).get('quarantine', []) if entry['until'] <= now)
+        if not matured:
+            return False
+        # the filter fails if another process promoted the same offsets in the meantime
+        after = await self.db_manager.find_one_and_update(
+            col_name=self.col_name,
+            fltr={'_id': value, 'quarantine.offset': {'$all': matured}},
+            update={'$pull': {'quarantine': {'offset': {'$in': matured}}},
+                    '$push': {'free': {'$each': matured, '$sort': 1}}})
+        if not after:
+            return False
+        self._cache(value, after['free'])
+        return True
+
+    def _may_have_free(self, value: int) -> bool:
+        """
+        Tells whether a value may have freed offsets, an empty cached list expires after free_cache_ttl.
+        """
+        cached = self._free.get(value)
+        return cached is None or bool(cached[1]) or time.monotonic() - cached[0] >= self.free_cache_ttl
+
+    async def add_order(self, order: Order) -> Order:
+        """
+        Allocates a value id for the order and stores it.
+
+        Parameters
+        ----------
+        order : Order
+            The new order without a value id.
+
+        Returns
+        -------
+        Order
+            The stored order.
+
+        Raises
+        ------
+        DuplicateError
+            If an order with the same invoice id already exists.
+        AllocateValueIdError
+            If no free value id could be allocated.
+        """
+        try:
+            for _ in range(self.max_attempts):
+                order.value_id = await self.allocate(order.value)
+                try:
+                    await self.db_manager.add_one('orders', order.serialize())
+                    return order
+                except DuplicateError as err:
+                    if 'value_id' not in err.key_pattern:
+                        await self.release(order)
+                        raise
+                    logging.warning(f'Value id {order.value_id} is already taken, resyncing the counter')
+                    await self._hold(order)
+                    await self._resync(order.value)
+        except DuplicateError:
+            raise
+        except MongoError as e:
+            raise AllocateValueIdError from e
+        raise AllocateValueIdError(f'Unable to allocate a value id for value {order.value}')
+
+    async def add_orders(self, orders: list[Order]) -> list[Order | MongoError]:
+        """
+        Allocates value ids for many orders and stores them with one bulk insert.
+
+        Orders whose value id turned out to be taken are retried one by one through
+        ``add_order``.
+
+        Parameters
+        ----------
+        orders : list
+            The new orders without value ids.
+
+        Returns
+        -------
+        list
+            For every order, the stored order or the error that prevented storing it,
+            a DuplicateError if an order with the same invoice id already exists.
+
+        Raises
+        ------
+        AllocateValueIdError
+            If value ids could not be allocated.
+        """
+        by_value: dict[int, list[Order]] = {}
+        for order in orders:
+            by_value.setdefault(order.value, []).append(order)
+        try:
+            for value, same_value in by_value.items():
+                for order, value_id in zip(same_value, await self.allocate_many(value, len(same_value))):
+                    order.value_id = value_id
+        except MongoError as e:
+            raise AllocateValueIdError from e
+
+        results = await self.db_manager.add_many_unordered('orders', [order.serialize() for order in orders])
+        stored: list[Order | MongoError] = []
+        for order, result in zip(orders, results):
+            if isinstance(result, DuplicateError) and 'value_id' in result.key_pattern:
+                try:
+                    await self._hold(order)
+                    result = await self.add_order(order)
+                except MongoError as e:
+                    result = e
+            elif isinstance(result, MongoError):
+                await self.release(order)
+            stored.append(result if isinstance(result, Exception) else order)
+        return stored
+
+    async def _hold(self, order: Order) -> None:
+        """
+        Quarantines the offset of a value id that collided with an order of another value.
+
+        An offset taken by an older order of the same value is left alone, it comes back
+        when that order leaves the NEW status.
+        """
+        taken = await self.db_manager.get_one(col_name='orders',
+                                              fltr={'value_id': order.value_id, 'status': OrderStatus.NEW.value},
+                                              projection={'_id': 0, 'value': 1})
+        if taken and taken['value'] == order.value:
+            return
+        offset = order.value_id - order.value
+        await self.db_manager.find_one_and_update(
+            col_name=self.col_name,
+            fltr={'_id': order.value, 'free': {'$ne': offset}, 'quarantine.offset': {'$ne': offset}},
+            update={'$push': {'quarantine': {'offset': offset, 'until': time.time() + self.collision_hold}}})
+
+    async def _resync(self, value: int) -> None:
+        """
+        Moves the counter past the highest value id held by a NEW order with this value.
+        """
+        highest = await self.db_manager.get_one(col_name='orders',
+                                                fltr={'value': value, 'status': OrderStatus.NEW.value},
+                                                sort=[('value_id', -1)],
+                                                projection={'_id': 0, 'value_id': 1})
+        if highest:
+            await self.db_manager.find_one_and_update(col_name=self.col_name,
+                                                      fltr={'_id': value},
+                                                      update={'$max': {'seq': highest['value_id'] - value + 1}},
+                                                      upsert=True)
+
+
+value_id_allocator = ValueIdAllocator(db_manager, grace=config_reader.config.value_id_grace)
@@ -0,0 +1,115 @@
+"""
+Shared setup of the tests.
+
+Run from the repository root:
+
+    pip install -r requirements-test.txt
+    python -m pytest tests
+
+The modules read their settings and build their singletons at import, so the settings
+are given through the environment before anything is imported, and the TON client is
+built without peers instead of downloading the testnet config. MongoDB is replaced by
+mongomock-motor behind the real ``Mongo`` class.
+"""
+import asyncio
+import os
+import sys
+
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import BulkWriteError, PyMongoError
+from pytoniq import LiteBalancer
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'src')]
+
+os.environ.setdefault('PAY_ADDRESS', 'EQD__________________________________________0vo')
+os.environ.setdefault('DATABASE', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_CLUSTER_NAME', 'tests')
+os.environ.setdefault('APP_PORT', '8000')
+
+LiteBalancer.from_testnet_config = classmethod(lambda cls, trust_level=0: cls(peers=[]))
+
+from src.db import Mongo  # noqa: E402
+from src.db_manager import DbManager  # noqa: E402
+
+
+def mock_mongo() -> Mongo:
+    """
+    Builds a Mongo backed by an in-memory mongomock database.
+    """
+    mongo = Mongo.__new__(Mongo)
+    mongo.client = AsyncMongoMockClient()
+    mongo.db = mongo.client['tests']
+    return mongo
+
+
+@pytest.fixture
+def mongo() -> Mongo:
+    return mock_mongo()
+
+
+@pytest.fixture
+def db_man(mongo: Mongo) -> DbManager:
+    return DbManager(mongo)
+
+
+class FlakyCollection:
+    """
+    A collection whose bulk writes fail for chosen documents, the others are applied.
+
+    ``failing`` maps a value of the ``key`` field to the number of bulk writes its update
+    still fails, like a real unordered ``BulkWriteError``. Reads fail while ``fail_reads``
+    is set.
+    """
+    def __init__(self, collection, key: str):
+        self.collection = collection
+        self.key = key
+        self.failing: dict = {}
+        self.fail_reads = False
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def find(self, *args, **kwargs):
+        if self.fail_reads:
+            raise PyMongoError('reads are failing')
+        return self.collection.find(*args, **kwargs)
+
+    async def bulk_write(self, requests, ordered=True):
+        failed = []
+        for i, request in enumerate(requests):
+            value = request._filter.get(self.key)
+            if self.failing.get(value, 0) > 0:
+                self.failing[value] -= 1
+                failed.append(i)
+        applied = [request for i, request in enumerate(requests) if i not in failed]
+        result = await self.collection.bulk_write(applied, ordered=False) if applied else None
+        if failed:
+            raise BulkWriteError({'writeErrors': [{'index': i, 'code': 91, 'errmsg': 'shutting down'} for i in failed],
+                                  'nMatched': result.matched_count if result else 0})
+        return result
+
+
+class FlakyDatabase:
+    """
+    A database whose orders collection is a FlakyCollection keyed by invoice_id.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.orders = FlakyCollection(db['orders'], 'invoice_id')
+
+    def __getitem__(self, col_name: str):
+        return self.orders if col_name == 'orders' else self.db[col_name]
+
+
+@pytest.fixture
+def flaky_orders(mongo: Mongo, monkeypatch) -> FlakyCollection:
+    original_sleep = asyncio.sleep
+
+    async def no_delay(delay, result=None):
+        return await original_sleep(0, result)
+
+    monkeypatch.setattr(asyncio, 'sleep', no_delay)
+    mongo.db = FlakyDatabase(mongo.db)
+    return mongo.db.orders
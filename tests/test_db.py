@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from src.exceptions import UpdateError
+
+
+def seed_orders(mongo, count: int) -> None:
+    asyncio.run(mongo.insert_many('orders', [{'invoice_id': i, 'status': 'new'} for i in range(1, count + 1)]))
+
+
+def confirm(invoice_ids: list[int]) -> list[tuple[dict, dict]]:
+    return [({'invoice_id': invoice_id, 'status': 'new'},
+             {'$set': {'status': 'confirmed', 'paid_by': f'tx{invoice_id}'}})
+            for invoice_id in invoice_ids]
+
+
+def statuses(mongo) -> dict[int, str]:
+    return {order['invoice_id']: order['status'] for order in asyncio.run(mongo.get_many('orders'))}
+
+
+def test_bulk_update_reports_filters_that_matched_nothing(mongo):
+    seed_orders(mongo, 2)
+    asyncio.run(mongo.update_one('orders', {'invoice_id': 2}, {'$set': {'status': 'canceled'}}))
+
+    assert asyncio.run(mongo.bulk_update('orders', confirm([1, 2]), key='invoice_id')) == [True, False]
+
+
+def test_bulk_update_retries_only_the_failed_updates(mongo, flaky_orders):
+    seed_orders(mongo, 3)
+    flaky_orders.failing[2] = 1
+
+    assert asyncio.run(mongo.bulk_update('orders', confirm([1, 2, 3]), key='invoice_id')) == [True, True, True]
+    assert statuses(mongo) == {1: 'confirmed', 2: 'confirmed', 3: 'confirmed'}
+
+
+def test_bulk_update_keeps_the_applied_updates_when_retries_run_out(mongo, flaky_orders):
+    seed_orders(mongo, 3)
+    flaky_orders.failing[2] = 10
+
+    assert asyncio.run(mongo.bulk_update('orders', confirm([1, 2, 3]), key='invoice_id')) == [True, False, True]
+    assert statuses(mongo) == {1: 'confirmed', 2: 'new', 3: 'confirmed'}
+
+
+def test_bulk_update_without_read_back_trusts_the_matched_count(mongo, flaky_orders):
+    seed_orders(mongo, 2)
+    flaky_orders.failing[2] = 10
+    flaky_orders.fail_reads = True
+
+    assert asyncio.run(mongo.bulk_update('orders', confirm([1, 2]), key='invoice_id')) == [True, False]
+
+
+def test_bulk_update_raises_when_nothing_was_written_or_read(mongo, flaky_orders):
+    seed_orders(mongo, 2)
+    flaky_orders.failing.update({1: 10, 2: 10})
+    flaky_orders.fail_reads = True
+
+    with pytest.raises(UpdateError):
+        asyncio.run(mongo.bulk_update('orders', confirm([1, 2]), key='invoice_id'))
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+from pymongo import IndexModel
+
+from src.exceptions import DuplicateError, InsertError
+from src.insert_coalescer import InsertCoalescer
+
+
+@pytest.fixture
+def batches(mongo, monkeypatch) -> list[int]:
+    sizes = []
+    insert_many_unordered = mongo.insert_many_unordered
+
+    async def recording(col_name, data, *args, **kwargs):
+        sizes.append(len(data))
+        return await insert_many_unordered(col_name, data, *args, **kwargs)
+
+    monkeypatch.setattr(mongo, 'insert_many_unordered', recording)
+    return sizes
+
+
+async def submit_all(coalescer: InsertCoalescer, documents: list[dict]) -> list:
+    return await asyncio.gather(*(coalescer.submit(document) for document in documents), return_exceptions=True)
+
+
+def test_inserts_within_the_window_share_one_batch(mongo, batches):
+    coalescer = InsertCoalescer(mongo, 'orders', window=0.01, max_batch=100)
+
+    results = asyncio.run(submit_all(coalescer, [{'invoice_id': i} for i in range(5)]))
+
+    assert batches == [5]
+    assert all(isinstance(result, str) for result in results)
+    assert len(asyncio.run(mongo.get_many('orders'))) == 5
+
+
+def test_a_full_batch_is_flushed_without_waiting_for_the_window(mongo, batches):
+    coalescer = InsertCoalescer(mongo, 'orders', window=60, max_batch=2)
+
+    results = asyncio.run(asyncio.wait_for(submit_all(coalescer, [{'invoice_id': i} for i in range(4)]), 1))
+
+    assert batches == [2, 2]
+    assert all(isinstance(result, str) for result in results)
+
+
+def test_every_caller_gets_the_result_of_its_own_document(mongo, batches):
+    asyncio.run(mongo.db['orders'].create_indexes([IndexModel([('invoice_id', 1)], unique=True)]))
+    coalescer = InsertCoalescer(mongo, 'orders', window=0.01, max_batch=100)
+
+    results = asyncio.run(submit_all(coalescer, [{'invoice_id': 1}, {'invoice_id': 1}, {'invoice_id': 2}]))
+
+    assert batches == [3]
+    assert isinstance(results[0], str) and isinstance(results[2], str)
+    assert isinstance(results[1], DuplicateError)
+
+
+def test_a_failed_batch_fails_every_caller(mongo, monkeypatch):
+    async def failing(col_name, data, *args, **kwargs):
+        raise InsertError('connection lost')
+
+    monkeypatch.setattr(mongo, 'insert_many_unordered', failing)
+    coalescer = InsertCoalescer(mongo, 'orders', window=0.01, max_batch=100)
+
+    results = asyncio.run(submit_all(coalescer, [{'invoice_id': i} for i in range(3)]))
+
+    assert all(isinstance(result, InsertError) for result in results)
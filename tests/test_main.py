@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+from pymongo import IndexModel
+
+from src import main
+from src.order_cache import order_cache
+from src.value_id_allocator import value_id_allocator
+
+
+@pytest.fixture(autouse=True)
+def app_db(db_man, monkeypatch):
+    asyncio.run(db_man.db.db['orders'].create_indexes([IndexModel([('invoice_id', 1)], unique=True)]))
+    for singleton in (value_id_allocator, order_cache):
+        monkeypatch.setattr(singleton, 'db_manager', db_man)
+    monkeypatch.setattr(value_id_allocator, '_free', {})
+    order_cache.clear()
+
+
+def post(path: str, body: dict):
+    async def request():
+        response = await main.app.test_client().post(path, json=body)
+        return response.status_code, await response.get_json()
+    return asyncio.run(request())
+
+
+def test_a_repeated_order_is_a_conflict():
+    assert post('/create_order', {'invoice_id': 1, 'value': 100})[0] == 200
+
+    assert post('/create_order', {'invoice_id': 1, 'value': 100}) == (409, {'error': 'invoice_id already exists'})
+
+
+def test_the_expiry_time_is_served_in_utc_from_the_cache_and_the_database():
+    _, created = post('/create_order', {'invoice_id': 1, 'value': 100})
+
+    async def get_order():
+        response = await main.app.test_client().get('/transactions', data='1')
+        return await response.get_json()
+
+    assert asyncio.run(get_order())['expires_at'] == created['expires_at']
+    order_cache.clear()
+    assert asyncio.run(get_order())['expires_at'] == created['expires_at']
+    assert created['expires_at'].endswith('+00:00')
+
+
+def test_a_batch_with_an_invalid_order_is_rejected_by_its_index():
+    status, body = post('/orders/batch', {'orders': [{'invoice_id': 1, 'value': 100}, {'invoice_id': 1}]})
+
+    assert (status, body) == (400, {'error': 'order at index 1 is invalid'})
+    assert post('/orders/status', {'invoice_ids': [1]}) == (200, {'1': None})
+
+
+def test_a_boolean_is_not_an_invoice_id():
+    assert post('/orders/status', {'invoice_ids': [True]})[0] == 400
@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+from pytoniq import LiteServerError
+
+from src.exceptions import WatchAccountError
+from ton_client import TonClient, LITESERVER_TIMEOUT_CODE
+
+ADDRESS = 'EQD__________________________________________0vo'
+
+
+def client_without_blocks(code: int) -> tuple[TonClient, list[int]]:
+    client = TonClient(peers=[])
+    client.min_block_wait_ms = 50
+    client._followed_seqno = 10
+    waits = []
+
+    async def wait_masterchain_seqno(seqno, timeout_ms, suffix):
+        waits.append(timeout_ms)
+        await asyncio.sleep(timeout_ms / 1000)
+        raise LiteServerError(code, 'timeout')
+
+    client.wait_masterchain_seqno = wait_masterchain_seqno
+    return client, waits
+
+
+def test_a_liteserver_timeout_is_no_new_block():
+    client, waits = client_without_blocks(LITESERVER_TIMEOUT_CODE)
+    client.block_wait_ms = 100
+
+    assert asyncio.run(client.wait_accounts_change([ADDRESS], 0.3)) == set()
+    assert client._followed_seqno == 10
+    assert all(timeout_ms >= client.min_block_wait_ms for timeout_ms in waits)
+
+
+def test_another_liteserver_error_restarts_following():
+    client, _ = client_without_blocks(-400)
+
+    with pytest.raises(WatchAccountError):
+        asyncio.run(client.wait_accounts_change([ADDRESS], 0.3))
+    assert client._followed_seqno is None
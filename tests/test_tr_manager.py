@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+from src.exceptions import CheckTransactionsError
+from src.model import Checkpoint, Order, OrderStatus, TransactionPage, TransactionRecord
+from src.value_id_allocator import value_id_allocator
+from tr_manager import TransactionManager
+
+ADDRESS = 'watched'
+
+
+class FakeClient:
+    """
+    A client that hands out prepared pages, newest first, and can fail after them.
+    """
+    def __init__(self, pages: list[list[TransactionRecord]], error: Exception | None = None):
+        self.pages = pages
+        self.error = error
+        self.to_lt = None
+
+    async def start(self):
+        pass
+
+    async def iter_new_transactions(self, address, to_lt=0, page_size=16, max_pages=None):
+        self.to_lt = to_lt
+        for transactions in self.pages:
+            newest = max(transactions, key=lambda tr: tr.lt)
+            yield TransactionPage(transactions, Checkpoint(address=address, lt=newest.lt, hash=newest.hash))
+        if self.error is not None:
+            await asyncio.sleep(0.05)  # lets the pages already fetched be written first
+            raise self.error
+
+
+def transaction(lt: int, value: int, comment: str | None = None) -> TransactionRecord:
+    return TransactionRecord(lt=lt, hash=f'hash{lt}', value=value, address=ADDRESS, comment=comment)
+
+
+def manager_for(db_man, pages, error=None) -> TransactionManager:
+    return TransactionManager(FakeClient(pages, error), db_man, addresses=[ADDRESS])
+
+
+@pytest.fixture(autouse=True)
+def orders(db_man, monkeypatch):
+    monkeypatch.setattr(value_id_allocator, 'db_manager', db_man)
+    monkeypatch.setattr(value_id_allocator, '_free', {})
+    for invoice_id, value in ((1, 100), (2, 200)):
+        asyncio.run(db_man.add_one('orders', Order(invoice_id=invoice_id, value=value, value_id=value).serialize()))
+        asyncio.run(db_man.update_one('value_ids', {'_id': value}, {'$set': {'seq': 1}}))
+
+
+def stored_orders(db_man) -> dict[int, dict]:
+    return {order['invoice_id']: order for order in asyncio.run(db_man.get_many('orders'))}
+
+
+def test_pages_are_matched_written_and_checkpointed(db_man):
+    manager = manager_for(db_man, [[transaction(30, 100), transaction(20, 5)], [transaction(10, 200)]])
+
+    assert asyncio.run(manager.check_address(ADDRESS)) == 3
+
+    orders = stored_orders(db_man)
+    assert orders[1]['status'] == OrderStatus.CONFIRMED.value and orders[1]['paid_by'] == 'hash30'
+    assert orders[2]['status'] == OrderStatus.CONFIRMED.value and orders[2]['paid_by'] == 'hash10'
+    assert len(asyncio.run(db_man.get_many('transactions'))) == 3
+    assert asyncio.run(db_man.get_one('checkpoints', {'address': ADDRESS}))['lt'] == 30
+    assert asyncio.run(db_man.get_one('value_ids', {'_id': 100}))['free'] == [0]
+
+
+def test_an_order_matched_by_an_earlier_page_is_not_paid_twice(db_man):
+    manager = manager_for(db_man, [[transaction(30, 100)], [transaction(10, 100)]])
+
+    asyncio.run(manager.check_address(ADDRESS))
+
+    assert stored_orders(db_man)[1]['paid_by'] == 'hash30'
+
+
+def test_the_next_cycle_starts_from_the_checkpoint(db_man):
+    asyncio.run(manager_for(db_man, [[transaction(30, 5)]]).check_address(ADDRESS))
+    manager = manager_for(db_man, [])
+
+    assert asyncio.run(manager.check_address(ADDRESS)) == 0
+    assert manager.client.to_lt == 30
+
+
+def test_a_failed_fetch_keeps_the_checkpoint(db_man):
+    manager = manager_for(db_man, [[transaction(30, 100)]], error=RuntimeError('liteserver gone'))
+
+    with pytest.raises(CheckTransactionsError):
+        asyncio.run(manager.check_address(ADDRESS))
+
+    assert asyncio.run(db_man.get_one('checkpoints', {'address': ADDRESS})) is None
+
+
+def test_a_payment_fetched_again_after_a_failed_cycle_pays_nothing_twice(db_man):
+    manager = manager_for(db_man, [[transaction(30, 100)]], error=RuntimeError('liteserver gone'))
+    with pytest.raises(CheckTransactionsError):
+        asyncio.run(manager.check_address(ADDRESS))
+    assert stored_orders(db_man)[1]['paid_by'] == 'hash30'
+    assert asyncio.run(db_man.get_one('checkpoints', {'address': ADDRESS})) is None
+
+    # the value id of the confirmed order is held back while its payment can be fetched again
+    assert asyncio.run(value_id_allocator.add_order(Order(invoice_id=3, value=100))).value_id == 101
+    asyncio.run(db_man.add_one('orders', Order(invoice_id=4, value=100, value_id=100).serialize()))
+
+    assert asyncio.run(manager_for(db_man, [[transaction(30, 100)]]).check_address(ADDRESS)) == 1
+
+    orders = stored_orders(db_man)
+    assert orders[3]['status'] == OrderStatus.NEW.value
+    assert orders[4]['status'] == OrderStatus.NEW.value
+    assert asyncio.run(db_man.get_one('checkpoints', {'address': ADDRESS}))['lt'] == 30
+
+
+def test_a_partially_failed_confirmation_still_releases_the_applied_orders(db_man, flaky_orders):
+    flaky_orders.failing[2] = 10
+    manager = manager_for(db_man, [[transaction(30, 100), transaction(20, 200)]])
+
+    asyncio.run(manager.check_address(ADDRESS))
+
+    orders = stored_orders(db_man)
+    assert orders[1]['status'] == OrderStatus.CONFIRMED.value
+    assert orders[2]['status'] == OrderStatus.NEW.value
+    assert asyncio.run(db_man.get_one('value_ids', {'_id': 100}))['free'] == [0]
+    assert 'free' not in asyncio.run(db_man.get_one('value_ids', {'_id': 200}))
+
+
+def test_only_the_legacy_address_starts_from_transactions_without_an_address(db_man):
+    asyncio.run(db_man.add_one('transactions', {'lt': 50, 'value': 100}))
+    manager = TransactionManager(FakeClient([]), db_man, addresses=[ADDRESS, 'added'], legacy_address=ADDRESS)
+
+    assert asyncio.run(manager.get_old_latest_transaction(ADDRESS)).lt == 50
+    assert asyncio.run(manager.get_old_latest_transaction('added')) is None
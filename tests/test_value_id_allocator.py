@@ -0,0 +1,72 @@
+import asyncio
+
+from pymongo import IndexModel
+
+from src.db_manager import DbManager
+from src.model import Order, OrderStatus
+from src.value_id_allocator import ValueIdAllocator
+
+
+def allocator_for(db_man: DbManager, grace: float = 0) -> ValueIdAllocator:
+    asyncio.run(db_man.db.db['orders'].create_indexes([IndexModel([('value_id', 1)], unique=True)]))
+    allocator = ValueIdAllocator(db_man, grace=grace)
+    allocator.free_cache_ttl = 0
+    return allocator
+
+
+def value_document(db_man: DbManager, value: int) -> dict:
+    return asyncio.run(db_man.get_one('value_ids', {'_id': value}))
+
+
+def test_allocate_counts_up_from_the_value(db_man):
+    allocator = allocator_for(db_man)
+
+    assert asyncio.run(allocator.allocate_many(100, 3)) == [100, 101, 102]
+    assert asyncio.run(allocator.allocate(100)) == 103
+
+
+def test_released_value_id_is_reused_smallest_first(db_man):
+    allocator = allocator_for(db_man)
+    asyncio.run(allocator.allocate_many(100, 4))
+
+    for value_id in (102, 101):
+        asyncio.run(allocator.release(Order(invoice_id=value_id, value=100, value_id=value_id,
+                                            status=OrderStatus.CONFIRMED.value)))
+
+    assert asyncio.run(allocator.allocate_many(100, 3)) == [101, 102, 104]
+
+
+def test_canceled_value_id_waits_in_quarantine(db_man):
+    allocator = allocator_for(db_man, grace=3600)
+    asyncio.run(allocator.allocate_many(100, 2))
+
+    asyncio.run(allocator.release(Order(invoice_id=1, value=100, value_id=101,
+                                        status=OrderStatus.CANCELED.value)))
+
+    assert asyncio.run(allocator.allocate(100)) == 102
+    asyncio.run(db_man.update_one('value_ids', {'_id': 100}, {'$set': {'quarantine.0.until': 0}}))
+    assert asyncio.run(allocator.allocate(100)) == 101
+    assert value_document(db_man, 100)['quarantine'] == []
+
+
+def test_value_id_of_another_value_is_quarantined_and_reused(db_man):
+    allocator = allocator_for(db_man)
+    asyncio.run(db_man.add_one('orders', Order(invoice_id=1, value=104, value_id=104).serialize()))
+    asyncio.run(allocator.allocate_many(100, 4))
+
+    order = asyncio.run(allocator.add_order(Order(invoice_id=2, value=100)))
+
+    assert order.value_id == 105
+    assert [entry['offset'] for entry in value_document(db_man, 100)['quarantine']] == [4]
+
+    asyncio.run(db_man.delete_one('orders', {'invoice_id': 1}))
+    asyncio.run(db_man.update_one('value_ids', {'_id': 100}, {'$set': {'quarantine.0.until': 0}}))
+    assert asyncio.run(allocator.add_order(Order(invoice_id=3, value=100))).value_id == 104
+
+
+def test_the_counter_starts_past_the_value_ids_of_existing_orders(db_man):
+    for invoice_id, value_id in ((1, 100), (2, 101)):
+        asyncio.run(db_man.add_one('orders', Order(invoice_id=invoice_id, value=100, value_id=value_id).serialize()))
+    allocator = ValueIdAllocator(db_man)
+
+    assert asyncio.run(allocator.allocate(100)) == 102